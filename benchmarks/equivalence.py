@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Equivalence check of the optimised code paths of candels-blender.
+
+Builds a small synthetic input dataset and fails if
+  - the fused kernel differs from the reference blending beyond the
+    float32 rounding, or does not give the same segmaps and shifts,
+  - concatenate gives different stacks when reading the individual files
+    with one or several threads, when streaming the stacks to disk or
+    when writing shards.
+
+Usage:
+    python benchmarks/equivalence.py [--n_blends 40] [--rtol 1e-5]
+"""
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from blender import Blender  # noqa: E402
+from blender.scripts.concatenate_blends import concatenate_products  # noqa: E402
+from blender.scripts.produce_blends import create_image_set  # noqa: E402
+from blender.shards import ShardedDataset, write_shards  # noqa: E402
+
+PRODUCTS = ("blends", "gg_masks", "ogg_masks", "bogg_masks", "single_images")
+
+
+def make_inputs(datadir, n_gal=40, seed=0):
+    """Write synthetic stamps, segmaps and catalogue of isolated galaxies"""
+    import pandas as pd
+
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[:128, :128]
+    img = rng.normal(0, 0.01, (n_gal, 128, 128))
+    seg = np.zeros((n_gal, 128, 128), dtype=np.int32)
+    for i in range(n_gal):
+        central = np.hypot(yy - 64, xx - 64) < rng.uniform(4, 12)
+        cy, cx = rng.randint(10, 30, 2)
+        neighbour = np.hypot(yy - cy, xx - cx) < 5
+        seg[i][central], seg[i][neighbour] = i + 1, 1000 + i
+        img[i] += central * np.exp(-np.hypot(yy - 64, xx - 64) / 4) + 0.5 * neighbour
+
+    datadir.mkdir()
+    np.save(datadir / "candels_img.npy", img)
+    np.save(datadir / "candels_seg.npy", seg)
+    pd.DataFrame({
+        "ID": np.arange(n_gal) + 100,
+        "mag": rng.uniform(20, 24, n_gal),
+        "radius": rng.uniform(3, 10, n_gal),
+        "z": rng.uniform(0, 3, n_gal),
+        "galtype": rng.choice(["disk", "sph", "irr"], n_gal),
+    }).to_csv(datadir / "candels_cat.csv", index=False)
+
+    return [datadir / name for name in ("candels_img.npy", "candels_seg.npy",
+                                        "candels_cat.csv")]
+
+
+def check_fused(inputs, n_blends):
+    """Largest relative difference between the fused and reference blends"""
+    outputs = {}
+    for backend in ("reference", "fused"):
+        # The strict noise is drawn from the global random state
+        np.random.seed(0)
+        blender = Blender(*inputs, seed=1, backend=backend)
+        blends = []
+        while len(blends) < n_blends:
+            blend = blender.next_blend()
+            if blend is not None:
+                blends.append(blend)
+        outputs[backend] = blends
+
+    worst = 0.0
+    for ref, fused in zip(outputs["reference"], outputs["fused"]):
+        if ref.shift != fused.shift or not np.array_equal(ref.segmap, fused.segmap):
+            return np.inf
+        scale = np.abs(ref.img).max()
+        worst = max(worst, np.abs(fused.img - ref.img).max() / scale)
+    return worst
+
+
+def check_concatenate(inputs, workdir, n_blends):
+    """Names of the concatenate variants differing from the sequential one"""
+    datadir = workdir / "blends"
+    datadir.mkdir()
+    blender = Blender(*inputs, seed=2, noise="bank")
+    create_image_set(blender, n_blends, datadir, n_writers=0)
+
+    def stacks(name, **kwargs):
+        outdir = workdir / name
+        outdir.mkdir()
+        products = {product: outdir / f"train_{product}.npy" for product in PRODUCTS}
+        concatenate_products(n_blends, datadir, "train", products, **kwargs)
+        return {product: filepath.read_bytes() for product, filepath in products.items()}
+
+    reference = stacks("sequential", n_jobs=1)
+    variants = {
+        "threads": stacks("threads", n_jobs=4),
+        "streamed": stacks("streamed", n_jobs=4, stream=True, chunk_size=7),
+    }
+    failed = [name for name, variant in variants.items() if variant != reference]
+
+    write_shards(n_blends, datadir, "train", list(PRODUCTS), shard_size=9, n_jobs=4)
+    sharded = ShardedDataset(datadir, "train")
+    for product in PRODUCTS:
+        expected = np.load(workdir / "sequential" / f"train_{product}.npy")
+        if not np.array_equal(sharded.array(product)[:], expected):
+            failed.append(f"shards ({product})")
+            break
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--n_blends", type=int, default=40)
+    parser.add_argument("--rtol", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir)
+        inputs = make_inputs(workdir / "data")
+
+        worst = check_fused(inputs, args.n_blends)
+        status = "ok" if worst <= args.rtol else "FAIL"
+        failed |= status == "FAIL"
+        print(f"{status:4s} {'fused kernel vs reference':40s} "
+              f"max relative difference {worst:.2e}")
+
+        differing = check_concatenate(inputs, workdir, args.n_blends)
+        status = "FAIL" if differing else "ok"
+        failed |= bool(differing)
+        print(f"{status:4s} {'concatenate vs sequential':40s} "
+              + (f"differs for {', '.join(differing)}" if differing
+                 else "threads, streamed and shards identical"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
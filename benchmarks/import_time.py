@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Startup-time regression check of the candels-blender CLI.
+
+Runs `python -X importtime` on each CLI module and fails if
+  - the cumulative import time exceeds the budget, or
+  - one of the heavy optional dependencies gets imported at startup.
+
+Usage:
+    python benchmarks/import_time.py [--budget-ms 300] [--repeat 5]
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+MODULES = [
+    "blender.scripts.cli",
+    "blender.scripts.produce_blends",
+    "blender.scripts.concatenate_blends",
+    "blender.scripts.cat2flux",
+    "blender.scripts.gallery",
+]
+FORBIDDEN = ["pandas", "scipy", "astropy", "matplotlib"]
+
+LINE_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+
+def import_profile(module):
+    """Return the cumulative import time (us) and the imported modules"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    cumulative = 0
+    imported = set()
+    for line in proc.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match is None:
+            continue
+        _, cumul, _, name = match.groups()
+        imported.add(name.split(".")[0])
+        if name == module:
+            cumulative = int(cumul)
+    return cumulative, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--budget-ms", type=float, default=300)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        # Best of several runs to dampen filesystem cache effects
+        runs = [import_profile(module) for _ in range(args.repeat)]
+        best_us = min(cumulative for cumulative, _ in runs)
+        heavy = sorted(set(FORBIDDEN) & runs[0][1])
+
+        status = "ok"
+        if best_us / 1e3 > args.budget_ms or heavy:
+            status = "FAIL"
+            failed = True
+        print(f"{status:4s} {module:40s} {best_us / 1e3:8.1f} ms"
+              + (f"  imports {', '.join(heavy)}" if heavy else ""))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
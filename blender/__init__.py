@@ -1,2 +1,2 @@
-from .core import Blend, Galaxy
+from .core import Blend, Galaxy, MultiBlend
 from .blender import Blender
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+Vectorised augmentation of the galaxy stamps.
+
+Each galaxy of a blend goes through one of the 8 symmetries of the square
+(90 degree rotations and flips) and optionally a random sub-pixel shift,
+applied identically to the masked stamp and to its cleaned segmap.
+
+The stamps are transformed about their central pixel (N // 2, N // 2),
+which is where the galaxies are centred, so that the galaxy centre does
+not move by half a pixel on even-sized stamps.
+
+All the functions work on batches of stamps of shape (..., N, N), and the
+random transformations are drawn from one seed per blend so that a given
+blend is reproducible whatever the batch it belongs to.
+"""
+from typing import Dict, Tuple
+
+import numpy as np  # type: ignore
+from numpy.random import RandomState
+
+from blender.core import Stamp
+
+
+def draw_augmentations(seeds: np.ndarray, n_gal: int,
+                       subpixel: bool = False) -> Dict[str, np.ndarray]:
+    """
+    Draw the random transformations of the galaxies of a batch of blends
+
+    Parameters
+    ----------
+    seeds:
+        one seed per blend, of shape (B,)
+    n_gal:
+        number of galaxies per blend
+
+    Returns
+    -------
+    dictionary of arrays of shape (B, K) for the `transpose`, `flip_y` and
+    `flip_x` booleans, plus (B, K, 2) `offsets` if `subpixel` is True
+
+    """
+    draws = []
+    for seed in seeds:
+        rng = RandomState(seed=seed)
+        flags = rng.randint(0, 2, size=(3, n_gal)).astype(bool)
+        offsets = rng.uniform(-0.5, 0.5, size=(n_gal, 2)) if subpixel else None
+        draws.append((flags, offsets))
+
+    flags = np.stack([flags for flags, _ in draws], axis=1)
+    augmentations = dict(transpose=flags[0], flip_y=flags[1], flip_x=flags[2])
+    if subpixel:
+        augmentations["offsets"] = np.stack([offsets for _, offsets in draws])
+
+    return augmentations
+
+
+def dihedral_transform(stamps: Stamp, transpose: np.ndarray,
+                       flip_y: np.ndarray, flip_x: np.ndarray) -> Stamp:
+    """
+    Apply per-stamp flips and transpositions about the central pixel
+
+    The combinations of the three boolean arrays, of the shape of the
+    batch, span the 8 rotations and reflections of the square stamps.
+    """
+    size = stamps.shape[-1]
+    direct = np.arange(size)
+    # Reflection i -> N - i (mod N) keeps the pixel N // 2 in place
+    reflected = -direct % size
+
+    rows = np.where(np.asarray(flip_y)[..., None], reflected, direct)
+    cols = np.where(np.asarray(flip_x)[..., None], reflected, direct)
+    output = np.take_along_axis(stamps, rows[..., :, None], axis=-2)
+    output = np.take_along_axis(output, cols[..., None, :], axis=-1)
+
+    transpose = np.asarray(transpose)[..., None, None]
+    return np.where(transpose, np.swapaxes(output, -1, -2), output)
+
+
+def subpixel_shift(stamps: Stamp, offsets: np.ndarray) -> Stamp:
+    """
+    Shift the stamps by fractional (dy, dx) offsets of shape (..., 2)
+    using a phase ramp in Fourier space.
+    """
+    size_y, size_x = stamps.shape[-2:]
+    freq_y = np.fft.fftfreq(size_y)[:, None]
+    freq_x = np.fft.rfftfreq(size_x)[None, :]
+    phase = np.exp(-2j * np.pi * (offsets[..., 0, None, None] * freq_y
+                                  + offsets[..., 1, None, None] * freq_x))
+
+    shifted = np.fft.irfft2(np.fft.rfft2(stamps) * phase, s=(size_y, size_x))
+    return shifted.astype(stamps.dtype)
+
+
+def augment(stamps: Stamp, segmaps: Stamp, seeds: np.ndarray,
+            subpixel: bool = False) -> Tuple[Stamp, Stamp]:
+    """
+    Randomly rotate, flip and optionally sub-pixel shift a batch of galaxies
+
+    Parameters
+    ----------
+    stamps, segmaps:
+        masked stamps and cleaned segmaps of shape (B, K, N, N)
+    seeds:
+        one seed per blend, of shape (B,)
+    subpixel: default False
+        also apply a random shift of less than half a pixel to the stamps,
+        the segmaps being left untouched
+
+    """
+    transforms = draw_augmentations(seeds, stamps.shape[1], subpixel=subpixel)
+    offsets = transforms.pop("offsets", None)
+
+    stamps = dihedral_transform(stamps, **transforms)
+    segmaps = dihedral_transform(segmaps, **transforms)
+    if offsets is not None:
+        stamps = subpixel_shift(stamps, offsets)
+
+    return stamps, segmaps
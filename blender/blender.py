@@ -1,15 +1,19 @@
 import logging
-from typing import List, Tuple, Union, Optional
+from typing import Dict, List, Tuple, Union, Optional
 from pathlib import Path
 
 import numpy as np  # type: ignore
-import pandas as pd  # type: ignore
 from numpy.random import RandomState
 
-from blender.core import Galaxy, Blend, Stamp
+from blender.core import Galaxy, Blend, MultiBlend, Stamp
+from blender.compositor import compose
+from blender.augment import augment
+from blender.noise import NoiseBank
 from blender.segmap import normalize_segmap
 from blender.segmap import mask_out_pixels
-from blender.visualisation import asin_stretch_norm
+from blender.segmap import fill_in_noise
+from blender.segmap import background_noise_std, neighbour_masks
+from blender.uniqueness import blend_keys
 
 PathType = Union[Path, str]
 
@@ -21,23 +25,121 @@ class BlendMissingTestError(Exception):
     pass
 
 
+class BlendGroupError(Exception):
+    pass
+
+
 class Blender:
     img_dtype = np.float32
     seg_dtype = np.uint8
 
     def __init__(self, imgpath: PathType, segpath: PathType, catpath: PathType,
                  train_test_ratio: float = 0.2,
-                 magdiff: int = 2, raddiff: int = 4, seed: int = 42) -> None:
+                 magdiff: int = 2, raddiff: int = 4, seed: int = 42,
+                 noise: str = "strict", augment: str = "none",
+                 backend: str = "reference") -> None:
+        import pandas as pd  # type: ignore
+
         self.data = np.load(imgpath).astype(self.img_dtype, copy=False)
         self.seg = np.load(segpath).astype(self.seg_dtype, copy=False)
         self.cat = pd.read_csv(catpath)
+        # Per-galaxy masks precomputed in a library, see `from_library`
+        self.masks: Optional[Dict[str, np.ndarray]] = None
+        self.configure(train_test_ratio, magdiff, raddiff, seed, noise, augment,
+                       backend)
+
+        self.assign_train_test()
+
+    def configure(self, train_test_ratio: float, magdiff: int, raddiff: int,
+                  seed: int, noise: str, augment: str = "none",
+                  backend: str = "reference") -> None:
+        """
+        Set the blending parameters
+
+        `noise` selects how the background noise of the masked stamps is
+        generated: "strict" for fresh draws for every stamp, "bank" for
+        tiles of a pre-generated noise bank (see `blender.noise.NoiseBank`).
+
+        `augment` selects the random transformations applied to the stamps
+        before blending (see `blender.augment`): "none", "dihedral" for
+        rotations and flips, "subpixel" for an additional sub-pixel shift.
+
+        `backend` selects the implementation of the masked two-galaxy
+        blends: "reference", or "fused" for the single-pass kernel of
+        `blender.kernels`, used when no augmentation is requested.
+        """
+        if noise not in ("strict", "bank"):
+            raise ValueError(f"Unknown noise mode {noise!r}")
+        if augment not in ("none", "dihedral", "subpixel"):
+            raise ValueError(f"Unknown augmentation {augment!r}")
+        if backend not in ("reference", "fused"):
+            raise ValueError(f"Unknown backend {backend!r}")
         self.tt_ratio = np.clip(train_test_ratio, 0, 1)
         self.magdiff = magdiff
         self.raddiff = raddiff
         self.rng = RandomState(seed=seed)
+        self.noise = NoiseBank(seed=seed, strict=(noise == "strict"))
+        self.augment = augment
+        self.backend = backend
         self.img_size = self.data.shape[-1]
-
-        self.assign_train_test()
+        # Galaxies with a possible companion per split, see `partnered_indices`
+        self.partnered: Dict[bool, np.ndarray] = {}
+
+    @classmethod
+    def from_library(cls, libdir: PathType, train_test_ratio: float = 0.2,
+                     magdiff: int = 2, raddiff: int = 4,
+                     seed: int = 42, noise: str = "strict",
+                     augment: str = "none",
+                     backend: str = "reference") -> "Blender":
+        """
+        Create a Blender from a library made by `blender.library.prepare_library`
+
+        The arrays are memory-mapped and the catalogue cuts are already
+        applied. For a given seed, the blends are identical to the ones of
+        a Blender built from the raw inputs on which the same cuts are made.
+        """
+        from blender.library import load_library
+
+        arrays, meta = load_library(libdir)
+
+        return cls.from_arrays(arrays, meta["n_gal_history"],
+                               train_test_ratio=train_test_ratio,
+                               magdiff=magdiff, raddiff=raddiff, seed=seed,
+                               noise=noise, augment=augment, backend=backend)
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict, n_gal_history: List[int],
+                    train_test_ratio: float = 0.2,
+                    magdiff: int = 2, raddiff: int = 4,
+                    seed: int = 42, noise: str = "strict",
+                    augment: str = "none",
+                    backend: str = "reference") -> "Blender":
+        """
+        Create a Blender from already loaded and selected galaxies
+
+        `arrays` holds the `stamps`, `segmaps` and `cat` of the galaxies and
+        their precomputed masks (see `blender.library.galaxy_masks`), and
+        `n_gal_history` the number of galaxies before and after each of
+        the cuts (see `blender.library.apply_cuts`). The arrays are shared,
+        not copied.
+        """
+        arrays = dict(arrays)
+
+        blender = cls.__new__(cls)
+        blender.data = arrays.pop("stamps")
+        blender.seg = arrays.pop("segmaps")
+        blender.cat = arrays.pop("cat")
+        blender.masks = arrays
+        blender.configure(train_test_ratio, magdiff, raddiff, seed, noise,
+                          augment, backend)
+
+        # Replay the train/test assignments of the initialisation and of
+        # every cut to draw the same random numbers as the raw inputs path
+        for n_gal in n_gal_history[:-1]:
+            blender.rng.permutation(n_gal)
+        blender.assign_train_test()
+
+        return blender
 
     @property
     def n_gal(self) -> int:
@@ -49,6 +151,7 @@ class Blender:
         test, train = np.split(randomized_indices, [split_idx])
         self.train_idx = train
         self.test_idx = test
+        self.partnered = {}
 
     def galaxy(self, idx: int) -> Galaxy:
         galfields = ["ID", "mag", "radius", "z", "galtype"]
@@ -71,22 +174,52 @@ class Blender:
         gal_id = gal.cat_id
 
         img = self.data[gal_id].copy()
+
+        if self.masks is not None:
+            masked_img = fill_in_noise(img,
+                                       self.masks["neighbours"][gal_id],
+                                       self.masks["background_std"][gal_id],
+                                       noise=self.noise)
+            return masked_img, self.clean_seg(gal_id)
+
         seg = self.seg[gal_id].copy()
         segval = seg[64, 64]
 
-        masked_img = mask_out_pixels(img, seg, segval)
+        masked_img = mask_out_pixels(img, seg, segval, noise=self.noise)
 
         return masked_img, self.clean_seg(gal_id)
 
+    def galaxy_masks(self, gal: Galaxy) -> Tuple[Stamp, Stamp, float]:
+        """
+        Return the cleaned segmap, the mask of the neighbours and the
+        background noise level of a galaxy stamp
+        """
+        gal_id = gal.cat_id
+
+        if self.masks is not None:
+            return (self.masks["clean_segs"][gal_id],
+                    self.masks["neighbours"][gal_id],
+                    self.masks["background_std"][gal_id])
+
+        seg = self.seg[gal_id]
+        background_mask, neighbours = neighbour_masks(seg, seg[64, 64])
+        background_std = background_noise_std(self.data[gal_id], background_mask)
+
+        return self.clean_seg(gal_id), neighbours, background_std
+
     def make_cut(self, logic) -> None:
         self.data = self.data[logic]
         self.seg = self.seg[logic]
         self.cat = self.cat[logic].reset_index(drop=True)
+        if self.masks is not None:
+            self.masks = {name: array[logic] for name, array in self.masks.items()}
 
         self.assign_train_test()
 
     def clean_seg(self, idx: int) -> Stamp:
         """Return the segmentation contours of the central object only"""
+        if self.masks is not None:
+            return np.array(self.masks["clean_segs"][idx])
         return np.where(self.seg[idx] == self.seg[idx, 64, 64],
                         1, 0).astype(self.seg_dtype)
 
@@ -105,7 +238,19 @@ class Blender:
         array = self.crop(array)
         return array
 
-    def blend(self, gal1: Galaxy, gal2: Galaxy, masked: bool = True) -> Blend:
+    def blend(self, gal1: Galaxy, gal2: Galaxy, masked: bool = True,
+              out: Optional[Tuple[Stamp, Stamp]] = None,
+              coords: Optional[List[int]] = None) -> Blend:
+        """
+        Blend two galaxies, the second one being randomly shifted
+
+        With the fused backend, the optional `out` buffers of shape
+        (N, N, 2) and (2, N, N) receive the blend image and segmap.
+        A given shift `coords` is used instead of a random one.
+        """
+        if masked and self.backend == "fused" and self.augment == "none":
+            return self.fused_blend(gal1, gal2, out=out, coords=coords)
+
         if masked:
             img, seg = self.masked_stamp(gal1)
             img2, seg2 = self.masked_stamp(gal2)
@@ -113,10 +258,16 @@ class Blender:
             img, seg = self.original_stamp(gal1, norm_segmap=True)
             img2, seg2 = self.original_stamp(gal2, norm_segmap=True)
 
-        coords = self.random_shift(gal1, gal2)
+        if coords is None:
+            coords = self.random_shift(gal1, gal2)
         if coords is None:
             raise BlendShiftError("Cannot find proper displacement")
 
+        if self.augment != "none":
+            stamps, segmaps = self.augment_stamps(np.stack([img, img2])[None],
+                                                  np.stack([seg, seg2])[None])
+            (img, img2), (seg, seg2) = stamps[0], segmaps[0]
+
         img2 = self.shift(img2, coords)
         seg2 = self.shift(seg2, coords)
 
@@ -134,6 +285,16 @@ class Blender:
             shift=coords
         )
 
+    def augment_stamps(self, stamps: Stamp,
+                       segmaps: Stamp) -> Tuple[Stamp, Stamp]:
+        """
+        Randomly transform a (B, K, N, N) batch of stamps and segmaps,
+        with one seed per blend drawn from the Blender random state.
+        """
+        seeds = self.rng.randint(2**31, size=len(stamps))
+        return augment(stamps, segmaps, seeds,
+                       subpixel=(self.augment == "subpixel"))
+
     def random_galaxy(self, from_test: bool = False) -> Galaxy:
         "Pick a random galaxy from the catalog"
         if from_test:
@@ -150,12 +311,43 @@ class Blender:
 
         return gal
 
+    def partnered_indices(self, from_test: bool = False) -> np.ndarray:
+        """
+        Catalogue indices of the galaxies of a split having at least one
+        other galaxy of the split within `magdiff`
+        """
+        if from_test not in self.partnered:
+            pool = self.split_indices(from_test)
+            mags = self.cat.mag.to_numpy()[pool]
+            # The closest galaxy in magnitude is a neighbour in sorted order
+            order = np.argsort(mags, kind="stable")
+            close = np.diff(mags[order]) < self.magdiff
+            partnered = np.zeros(len(pool), dtype=bool)
+            partnered[order[:-1][close]] = True
+            partnered[order[1:][close]] = True
+            self.partnered[from_test] = pool[partnered]
+
+        return self.partnered[from_test]
+
     def random_pair(self, from_test: bool = False) -> Tuple[Galaxy, Galaxy]:
-        "Pick a random pair of galaxies with specific flux constrains"
-        gal1 = self.random_galaxy(from_test)
+        """
+        Pick a random pair of distinct galaxies with specific flux constrains
+
+        The first galaxy is drawn among the ones having a possible companion,
+        `BlendGroupError` being raised when there is none.
+        """
+        pool = self.partnered_indices(from_test)
+        if len(pool) == 0:
+            split = "test" if from_test else "train"
+            raise BlendGroupError(
+                f"No 2 galaxies of the {split} split are within "
+                f"{self.magdiff} magnitudes of each other")
+
+        gal1 = self.galaxy(self.rng.choice(pool))
         gal2 = self.random_galaxy(from_test)
 
-        while not np.abs(gal1.mag - gal2.mag) < self.magdiff:
+        while (gal2.cat_id == gal1.cat_id
+               or not np.abs(gal1.mag - gal2.mag) < self.magdiff):
             gal2 = self.random_galaxy(from_test)
 
         return gal1, gal2
@@ -169,6 +361,9 @@ class Blender:
 
         if rad_min >= rad_max:
             rad_min = 0.8 * rad_max
+        if rad_max < 1:
+            # No integer shift to draw from
+            return None
 
         tryouts = 25
         coords = [0, 0]
@@ -182,11 +377,35 @@ class Blender:
 
     def next_blend(self,
                    from_test: bool = False,
-                   masked: bool = True) -> Optional[Blend]:
+                   masked: bool = True,
+                   unique=None) -> Optional[Blend]:
+        """
+        Produce a blend of two random galaxies, or None if it failed
+
+        With a key set of `blender.uniqueness` as `unique`, the pair and
+        shift are drawn first and the blend is dropped if already produced.
+        """
         gal1, gal2 = self.random_pair(from_test)
 
+        coords = None
+        if unique is not None:
+            logger = logging.getLogger(__name__)
+            coords = self.random_shift(gal1, gal2)
+            if coords is None:
+                # Blending would draw another shift, missing from the key set
+                logger.info(
+                    f"Issue while blending galaxies {gal1.gal_id} and "
+                    f"{gal2.gal_id}: Cannot find proper displacement")
+                return None
+            key = blend_keys([[gal1.cat_id, gal2.cat_id]], [[[0, 0], coords]])
+            if not unique.add(key)[0]:
+                logger.debug(
+                    f"Duplicated blend of galaxies {gal1.gal_id} and "
+                    f"{gal2.gal_id} with shift {coords}")
+                return None
+
         try:
-            blend = self.blend(gal1, gal2, masked=masked)
+            blend = self.blend(gal1, gal2, masked=masked, coords=coords)
         except BlendShiftError as e:
             logger = logging.getLogger(__name__)
             logger.info(
@@ -196,8 +415,243 @@ class Blender:
 
         return blend
 
+    def fused_blend(self, gal1: Galaxy, gal2: Galaxy,
+                    out: Optional[Tuple[Stamp, Stamp]] = None,
+                    coords: Optional[List[int]] = None) -> Blend:
+        """
+        Blend two masked galaxies with the single-pass kernel
+
+        Equivalent to the masked `blend` up to the float32 rounding, and
+        drawing the same random numbers.
+        """
+        from blender.kernels import fuse_galaxy
+
+        shape = (self.img_size, self.img_size)
+        galaxies = (gal1, gal2)
+        masks = [self.galaxy_masks(gal) for gal in galaxies]
+        noises = [(self.noise.standard(shape), self.noise.standard(shape))
+                  for _ in galaxies]
+
+        if coords is None:
+            coords = self.random_shift(gal1, gal2)
+        if coords is None:
+            raise BlendShiftError("Cannot find proper displacement")
+
+        if out is None:
+            img_cube = np.empty((*shape, 2), dtype=self.img_dtype)
+            seg_cube = np.empty((2, *shape), dtype=self.seg_dtype)
+        else:
+            img_cube, seg_cube = out
+
+        shifts = ([0, 0], coords)
+        for k, gal in enumerate(galaxies):
+            clean_seg, neighbours, background_std = masks[k]
+            noise_fill, noise_add = noises[k]
+            fuse_galaxy(self.data[gal.cat_id], neighbours, clean_seg,
+                        background_std, noise_fill, noise_add, shifts[k],
+                        img_cube[..., k], seg_cube[k])
+
+        return Blend(
+            img=img_cube,
+            segmap=seg_cube,
+            gal1=gal1,
+            gal2=gal2,
+            shift=coords
+        )
+
+    def split_indices(self, from_test: bool = False) -> np.ndarray:
+        "Catalogue indices of the galaxies of the train or test split"
+        if from_test:
+            if len(self.test_idx) == 0:
+                raise BlendMissingTestError(
+                    "The test set has not been specified. "
+                    "Initialize the blender with a non-zero "
+                    "`train_test_ratio`.")
+            return self.test_idx
+
+        return self.train_idx
+
+    def random_groups(self, n_blends: int, n_gal: int,
+                      from_test: bool = False) -> np.ndarray:
+        """
+        Pick groups of galaxies with specific flux constrains
+
+        All the galaxies of a group are distinct and have magnitudes within
+        `magdiff` of each other. Returns the catalogue indices as a (n_blends, n_gal)
+        array, the first galaxy of each group being the central one.
+
+        The groups whose first galaxies leave no possible companion are
+        drawn again, and `BlendGroupError` is raised when no group can be
+        formed or when some are still missing after a number of tries.
+        """
+        tryouts = 100
+        pool = self.split_indices(from_test)
+        mags = self.cat.mag.to_numpy()
+        sorted_mags = np.sort(mags[pool])
+
+        # Largest number of galaxies within magdiff of each other
+        window = np.searchsorted(sorted_mags, sorted_mags + self.magdiff)
+        if np.max(window - np.arange(len(pool)), initial=0) < n_gal:
+            split = "test" if from_test else "train"
+            raise BlendGroupError(
+                f"No {n_gal} galaxies of the {split} split are within "
+                f"{self.magdiff} magnitudes of each other")
+
+        groups = self.rng.choice(pool, size=(n_blends, n_gal))
+        todo = np.arange(n_blends)
+        for _ in range(tryouts):
+            stuck = np.zeros(n_blends, dtype=bool)
+            for k in range(1, n_gal):
+                # Redraw the k-th galaxy of the groups violating the constraint
+                redraw = todo[~stuck[todo]]
+                while redraw.size:
+                    # Leave the groups whose first k galaxies admit no other
+                    # one, with a margin against rounding errors
+                    fixed = mags[groups[redraw, :k]]
+                    low = np.searchsorted(sorted_mags,
+                                          fixed.max(axis=1) - self.magdiff + 1e-6)
+                    high = np.searchsorted(sorted_mags,
+                                           fixed.min(axis=1) + self.magdiff - 1e-6)
+                    dead = high - low <= k
+                    stuck[redraw[dead]] = True
+                    redraw = redraw[~dead]
+
+                    groups[redraw, k] = self.rng.choice(pool, size=redraw.size)
+                    group_mags = mags[groups[redraw, :k + 1]]
+                    magdiff = np.abs(group_mags[:, k, None] - group_mags[:, :k])
+                    distinct = groups[redraw, k, None] != groups[redraw, :k]
+                    redraw = redraw[~np.all((magdiff < self.magdiff) & distinct, axis=1)]
+
+            # Draw the stuck groups again from their central galaxy
+            todo = np.flatnonzero(stuck)
+            if not todo.size:
+                return groups
+            groups[todo] = self.rng.choice(pool, size=(todo.size, n_gal))
+
+        raise BlendGroupError(
+            f"Cannot find {todo.size} groups of {n_gal} galaxies within "
+            f"{self.magdiff} magnitudes of each other after {tryouts} tries")
+
+    def random_shifts(self, groups: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Draw the shifts of the companions of groups of galaxies
+
+        Each companion is shifted with respect to the central galaxy with
+        the same radius constraints as `random_shift`. In addition, two
+        companions are kept apart by at least the biggest of their radii.
+
+        Returns
+        -------
+        shifts:
+            (n_blends, n_gal, 2) integer array of (dy, dx) offsets, zero for
+            the central galaxy
+        found:
+            (n_blends,) boolean array, False for the groups where no
+            proper displacement was found
+
+        """
+        tryouts = 25
+        n_blends, n_gal = groups.shape
+        rads = self.cat.radius.to_numpy()[groups]
+
+        shifts = np.zeros((n_blends, n_gal, 2), dtype=int)
+        found = np.ones(n_blends, dtype=bool)
+        for k in range(1, n_gal):
+            # Min radius has to be the biggest of both effective radii
+            rad_min = np.maximum(rads[:, 0], rads[:, k])
+            # Max radius is defined as a factor of the smallest effective radius
+            rad_max = np.minimum(np.minimum(rads[:, 0], rads[:, k]) * self.raddiff,
+                                 self.img_size // 2)
+            rad_min = np.where(rad_min >= rad_max, 0.8 * rad_max, rad_min)
+
+            bound = np.maximum(np.trunc(rad_max).astype(int), 1)[:, None]
+            coords = self.rng.randint(-bound, bound, size=(tryouts, n_blends, 2))
+            distance = np.hypot(coords[..., 0], coords[..., 1])
+            valid = (rad_min <= distance) & (distance <= rad_max)
+            for j in range(1, k):
+                offset = coords - shifts[:, j]
+                separation = np.hypot(offset[..., 0], offset[..., 1])
+                valid &= separation >= np.maximum(rads[:, j], rads[:, k])
+
+            found &= valid.any(axis=0)
+            shifts[:, k] = coords[valid.argmax(axis=0), np.arange(n_blends)]
+
+        return shifts, found
+
+    def next_blends(self, n_blends: int, n_gal: int = 2,
+                    from_test: bool = False,
+                    masked: bool = True,
+                    unique=None) -> List[MultiBlend]:
+        """
+        Produce a batch of blends of `n_gal` galaxies
+
+        The galaxies and their shifts are drawn for the whole batch at
+        once, and the stamps are shifted and stacked by the vectorised
+        compositor of `blender.compositor`. With a key set of
+        `blender.uniqueness` as `unique`, the blends already produced are
+        drawn again, and `BlendGroupError` is raised when no new blend is
+        found in 100 successive draws of the missing blends.
+        """
+        tryouts = 100
+        groups = np.empty((0, n_gal), dtype=int)
+        shifts = np.empty((0, n_gal, 2), dtype=int)
+        failures = 0
+        while len(groups) < n_blends:
+            if failures >= tryouts:
+                raise BlendGroupError(
+                    f"Could not draw {n_blends - len(groups)} more new blends "
+                    f"of {n_gal} galaxies after {tryouts} tries, most of the "
+                    "blends allowed by the cuts may have been produced already")
+            new_groups = self.random_groups(n_blends - len(groups), n_gal,
+                                            from_test)
+            new_shifts, found = self.random_shifts(new_groups)
+            if not found.all():
+                logger = logging.getLogger(__name__)
+                for group in new_groups[~found]:
+                    logger.info(
+                        f"Issue while blending galaxies {group.tolist()}: "
+                        "Cannot find proper displacement")
+            if unique is not None:
+                new = unique.add(blend_keys(new_groups[found], new_shifts[found]))
+                if not new.all():
+                    logger = logging.getLogger(__name__)
+                    logger.debug(f"{np.sum(~new)} duplicated blends drawn again")
+                found[found] = new
+            failures = 0 if found.any() else failures + 1
+            groups = np.concatenate([groups, new_groups[found]])
+            shifts = np.concatenate([shifts, new_shifts[found]])
+
+        galaxies = {idx: self.galaxy(idx) for idx in np.unique(groups)}
+
+        stamp_shape = (n_blends, n_gal, self.img_size, self.img_size)
+        stamps = np.empty(stamp_shape, dtype=self.img_dtype)
+        segmaps = np.empty(stamp_shape, dtype=self.seg_dtype)
+        for b, group in enumerate(groups):
+            for k, idx in enumerate(group):
+                if masked:
+                    stamps[b, k], segmaps[b, k] = self.masked_stamp(galaxies[idx])
+                else:
+                    stamps[b, k], segmaps[b, k] = self.original_stamp(
+                        galaxies[idx], norm_segmap=True)
+
+        if self.augment != "none":
+            stamps, segmaps = self.augment_stamps(stamps, segmaps)
+
+        img_cube, seg_cube = compose(stamps, segmaps, shifts)
+
+        return [
+            MultiBlend(
+                img=img_cube[b],
+                segmap=seg_cube[b],
+                galaxies=[galaxies[idx] for idx in group],
+                shifts=shifts[b].tolist(),
+            )
+            for b, group in enumerate(groups)
+        ]
+
     def plot_galaxy(self, idx: int) -> None:
         import matplotlib.pyplot as plt
+        from blender.visualisation import asin_stretch_norm
 
         title_list = [
             "Galaxy stamp",
@@ -222,6 +676,7 @@ class Blender:
 
     def plot_blend(self, idx1: int, idx2: int, masked: bool = True):
         import matplotlib.pyplot as plt
+        from blender.visualisation import asin_stretch_norm
 
         g1 = self.galaxy(idx1)
         g2 = self.galaxy(idx2)
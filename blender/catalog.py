@@ -1,8 +1,9 @@
-from typing import List, Sequence
+from typing import Dict, List, Optional, Sequence, Union
 
 import numpy as np  # type: ignore
 
-from blender.core import Blend, Galaxy
+from blender.core import Blend, Galaxy, MultiBlend
+from blender.segmap import overlap_statistics
 
 CATALOG_HEADER: Sequence[str] = (
     "id",
@@ -19,9 +20,41 @@ CATALOG_HEADER: Sequence[str] = (
     "g2_rad",
     "g2_z",
     "g2_type",
+    "overlap_area",
+    "g1_blendedness",
+    "g2_blendedness",
+    "g1_overlap_frac",
+    "g2_overlap_frac",
 )
 
 
+GALAXY_FIELDS: Sequence[str] = ("id", "mag", "rad", "z", "type")
+
+
+def catalog_header(n_gal: int = 2) -> Sequence[str]:
+    """
+    Catalogue columns of blends of `n_gal` galaxies
+
+    Two-galaxy blends use `CATALOG_HEADER`. For more galaxies, each
+    companion has its own distance and shift to the central galaxy.
+    """
+    if n_gal == 2:
+        return CATALOG_HEADER
+
+    galaxies = range(1, n_gal + 1)
+    companions = range(2, n_gal + 1)
+    return (
+        ("id",)
+        + tuple(f"g{i}_{field}"
+                for i in companions
+                for field in ("distance", "shift_x", "shift_y"))
+        + tuple(f"g{i}_{field}" for i in galaxies for field in GALAXY_FIELDS)
+        + ("overlap_area",)
+        + tuple(f"g{i}_blendedness" for i in galaxies)
+        + tuple(f"g{i}_overlap_frac" for i in galaxies)
+    )
+
+
 def gal2cat(gal: Galaxy) -> List[str]:
     """
     id rad mag z type
@@ -37,9 +70,42 @@ def gal2cat(gal: Galaxy) -> List[str]:
     return galinfo
 
 
-def blend2cat(blend: Blend, idx: int) -> List[str]:
+def batch_overlap_statistics(
+        blends: Sequence[Union[Blend, MultiBlend]]) -> List[Dict[str, float]]:
+    """
+    Overlap statistics of a batch of blends with the same number of
+    galaxies, computed at once and split into one dictionary per blend
+    """
+    stats = overlap_statistics([blend.img for blend in blends],
+                               [blend.segmap for blend in blends])
+    return [{key: values[b] for key, values in stats.items()}
+            for b in range(len(blends))]
+
+
+def overlap2cat(blend: Union[Blend, MultiBlend],
+                stats: Optional[Dict[str, float]] = None) -> List[str]:
     """
-    blend_id distance gal1_id gal1_mag gal1_rad gal1_z gal1_type gal2_id gal2_mag gal2_rad gal2_z gal2_type  # noqa
+    overlap_area gal1_blendedness ... galK_blendedness gal1_overlap_frac ... galK_overlap_frac
+
+    `stats` are the statistics of the blend if already computed, see
+    `batch_overlap_statistics`.
+    """
+    if stats is None:
+        stats = overlap_statistics(blend.img, blend.segmap)
+    n_gal = blend.segmap.shape[0]
+    keys = ([f"g{i}_blendedness" for i in range(1, n_gal + 1)]
+            + [f"g{i}_overlap_frac" for i in range(1, n_gal + 1)])
+    overlapinfo: List[str] = [f"{stats['overlap_area']}"] + [
+        f"{stats[key]:.6f}" for key in keys
+    ]
+
+    return overlapinfo
+
+
+def blend2cat(blend: Blend, idx: int,
+              stats: Optional[Dict[str, float]] = None) -> List[str]:
+    """
+    blend_id distance gal1_id gal1_mag gal1_rad gal1_z gal1_type gal2_id gal2_mag gal2_rad gal2_z gal2_type overlap_area gal1_blendedness gal2_blendedness gal1_overlap_frac gal2_overlap_frac  # noqa
     """
     distance = np.hypot(*blend.shift)
     blendinfo: List[str] = [
@@ -49,4 +115,23 @@ def blend2cat(blend: Blend, idx: int) -> List[str]:
         f"{blend.shift[1]}",
     ]
 
-    return blendinfo + gal2cat(blend.gal1) + gal2cat(blend.gal2)
+    return (blendinfo + gal2cat(blend.gal1) + gal2cat(blend.gal2)
+            + overlap2cat(blend, stats))
+
+
+def multiblend2cat(blend: MultiBlend, idx: int,
+                   stats: Optional[Dict[str, float]] = None) -> List[str]:
+    """
+    blend_id (gal_distance gal_shift_x gal_shift_y for each companion) (gal_id gal_mag gal_rad gal_z gal_type for each galaxy) overlap_area (gal_blendedness) (gal_overlap_frac)  # noqa
+    """
+    blendinfo: List[str] = [f"{idx}"]
+    for shift in blend.shifts[1:]:
+        blendinfo += [
+            f"{np.hypot(*shift):.6f}",
+            f"{shift[0]}",
+            f"{shift[1]}",
+        ]
+    for gal in blend.galaxies:
+        blendinfo += gal2cat(gal)
+
+    return blendinfo + overlap2cat(blend, stats)
@@ -0,0 +1,82 @@
+"""
+Vectorised composition of blends of any number of galaxies.
+
+The functions work on batches of B blends of K galaxies at once:
+  - stamps of shape (B, K, N, N)
+  - shifts of shape (B, K, 2), as (dy, dx) pixel offsets
+and produce the blend components in the `blender.core.Blend` layout,
+that is images of shape (B, N, N, K) and segmaps of shape (B, K, N, N).
+"""
+from typing import Optional, Tuple
+
+import numpy as np  # type: ignore
+
+from blender.core import Stamp
+
+
+def shift_stamps(stamps: Stamp, shifts: Stamp) -> Stamp:
+    """
+    Translate a batch of stamps by integer offsets, filling with zeros
+
+    Equivalent to `Blender.shift` applied to every stamp, for offsets
+    smaller than half the stamp size.
+
+    Parameters
+    ----------
+    stamps:
+        array of shape (..., N, N)
+    shifts:
+        integer array of shape (..., 2) holding the (dy, dx) offsets
+
+    """
+    size_y, size_x = stamps.shape[-2:]
+    shifts = np.asarray(shifts, dtype=np.intp)
+    # Source pixel of each output pixel, per stamp
+    src_y = np.arange(size_y) - shifts[..., 0, None]
+    src_x = np.arange(size_x) - shifts[..., 1, None]
+    valid_y = (src_y >= 0) & (src_y < size_y)
+    valid_x = (src_x >= 0) & (src_x < size_x)
+
+    rows = np.take_along_axis(stamps,
+                              np.clip(src_y, 0, size_y - 1)[..., :, None],
+                              axis=-2)
+    shifted = np.take_along_axis(rows,
+                                 np.clip(src_x, 0, size_x - 1)[..., None, :],
+                                 axis=-1)
+    valid = valid_y[..., :, None] & valid_x[..., None, :]
+
+    return np.where(valid, shifted, 0).astype(stamps.dtype, copy=False)
+
+
+def compose(stamps: Stamp, segmaps: Stamp, shifts: Stamp,
+            out_img: Optional[Stamp] = None,
+            out_seg: Optional[Stamp] = None) -> Tuple[Stamp, Stamp]:
+    """
+    Shift the galaxies of a batch of blends and stack them as channels
+
+    Parameters
+    ----------
+    stamps:
+        masked galaxy stamps of shape (B, K, N, N)
+    segmaps:
+        galaxy segmaps of shape (B, K, N, N)
+    shifts:
+        integer offsets of shape (B, K, 2), zeros for the central galaxy
+    out_img, out_seg: optional
+        buffers of shape (B, N, N, K) and (B, K, N, N) receiving the output
+
+    Returns
+    -------
+    images of shape (B, N, N, K) and segmaps of shape (B, K, N, N)
+
+    """
+    if out_img is None:
+        out_img = np.empty((stamps.shape[0], *stamps.shape[2:], stamps.shape[1]),
+                           dtype=stamps.dtype)
+    if out_seg is None:
+        out_seg = np.empty_like(segmaps)
+
+    out_img[...] = np.moveaxis(shift_stamps(stamps, shifts), 1, -1)
+    out_seg[...] = shift_stamps(segmaps, shifts)
+
+    return out_img, out_seg
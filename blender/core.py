@@ -25,3 +25,13 @@ Blend = NamedTuple(
         ("shift", List[int]),
     ],
 )
+
+MultiBlend = NamedTuple(
+    "MultiBlend",
+    [
+        ("img", Stamp),
+        ("segmap", Stamp),
+        ("galaxies", List[Galaxy]),
+        ("shifts", List[List[int]]),
+    ],
+)
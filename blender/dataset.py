@@ -0,0 +1,227 @@
+"""
+Reader of the datasets created by `candels-blender produce` and
+`candels-blender concatenate`.
+
+The stacked arrays (`<prefix>_blends.npy`, `<prefix>_<method>.npy`) are
+memory-mapped and the catalogue is converted once to one `.npy` file per
+column, also memory-mapped. Selections are vectorised over the catalogue
+columns, and only the matching stamps are read from disk, grouped into
+contiguous ranges. The products stored with a reduced precision are
+converted back to float32 when read, see `blender.precision`.
+
+Example
+-------
+>>> dataset = BlendDataset("output-s_42-n_20000", prefix="train")
+>>> idx = dataset.where("distance < 10 and g1_mag < 23 and g2_mag < 23")
+>>> subset = dataset.take(idx, products=["blends", "ogg_masks"])
+"""
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np  # type: ignore
+
+from blender.precision import IMAGE_PRODUCTS, dequantise
+
+PathType = Union[Path, str]
+
+
+def contiguous_ranges(indices: np.ndarray,
+                      max_gap: int = 0) -> List[Tuple[int, int]]:
+    """
+    Group sorted indices into [start, stop) ranges
+
+    Indices separated by at most `max_gap` missing entries are merged in
+    the same range, trading a few unneeded rows for fewer reads.
+    """
+    indices = np.asarray(indices)
+    if indices.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) > max_gap + 1) + 1
+    starts = indices[np.r_[0, breaks]]
+    stops = indices[np.r_[breaks - 1, indices.size - 1]] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def read_rows(array: np.ndarray, indices: np.ndarray,
+              max_gap: int = 0) -> np.ndarray:
+    """
+    Read the rows of a (memory-mapped) array at the given sorted indices
+    with one contiguous read per range of indices.
+    """
+    output = np.empty((len(indices), *array.shape[1:]), dtype=array.dtype)
+    position = 0
+    for start, stop in contiguous_ranges(indices, max_gap=max_gap):
+        block = np.asarray(array[start:stop])
+        end = np.searchsorted(indices, stop, side="left")
+        output[position:end] = block[indices[position:end] - start]
+        position = end
+    return output
+
+
+def evaluate_condition(columns: Dict[str, np.ndarray],
+                       condition: Union[str, Callable]) -> np.ndarray:
+    """
+    Return the sorted indices of the rows of `columns` matching a condition,
+    see `BlendDataset.where`
+    """
+    if callable(condition):
+        mask = condition(columns)
+    else:
+        import pandas as pd  # type: ignore
+        # Series, not arrays, so that string comparisons work elementwise
+        series = {name: pd.Series(column, copy=False)
+                  for name, column in columns.items()}
+        mask = pd.eval(condition, resolvers=[series])
+
+    return np.flatnonzero(np.asarray(mask, dtype=bool))
+
+
+class BlendDataset:
+    """
+    Queryable view over one split of a produced dataset
+
+    Parameters
+    ----------
+    path:
+        directory of the dataset
+    prefix: {'train','test'}
+        split of the dataset
+
+    """
+    def __init__(self, path: PathType, prefix: str = "train") -> None:
+        self.path = Path(path)
+        self.prefix = prefix
+        self.catpath = self.path / f"{prefix}_catalogue.csv"
+        self.columns = self._load_columns()
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values())))
+
+    @property
+    def products(self) -> List[str]:
+        """Names of the stacked arrays available for this split"""
+        return sorted(
+            path.stem[len(self.prefix) + 1:]
+            for path in self.path.glob(f"{self.prefix}_*.npy")
+            if "_blend_" not in path.name
+        )
+
+    def array(self, product: str) -> np.ndarray:
+        """Memory-mapped array of a product, e.g. 'blends' or 'ogg_masks'"""
+        filepath = self.path / f"{self.prefix}_{product}.npy"
+        if not filepath.exists():
+            raise FileNotFoundError(
+                f"No {product} for the {self.prefix} split in {self.path}, "
+                f"available products are {self.products}")
+        return np.load(filepath, mmap_mode="r")
+
+    def _load_columns(self) -> Dict[str, np.ndarray]:
+        """
+        Memory-map the catalogue columns, converting the CSV catalogue
+        to columns first if needed.
+        """
+        coldir = self.path / f"{self.prefix}_catalogue"
+        index = coldir / "columns.json"
+        if (not index.exists()
+                or index.stat().st_mtime < self.catpath.stat().st_mtime):
+            self._write_columns(coldir)
+
+        with open(index) as f:
+            names = json.load(f)
+
+        return {
+            name: np.load(coldir / f"{name}.npy", mmap_mode="r")
+            for name in names
+        }
+
+    def _write_columns(self, coldir: Path) -> None:
+        import pandas as pd  # type: ignore
+
+        cat = pd.read_csv(self.catpath)
+
+        tmpdir = coldir.with_name(f".{coldir.name}-{os.getpid()}")
+        tmpdir.mkdir(exist_ok=True)
+        for name in cat.columns:
+            values = cat[name].to_numpy()
+            if values.dtype.kind == "O":
+                values = values.astype(str)
+            np.save(tmpdir / f"{name}.npy", values)
+        with open(tmpdir / "columns.json", "w") as f:
+            json.dump(list(cat.columns), f)
+
+        if coldir.exists():
+            shutil.rmtree(coldir)
+        try:
+            tmpdir.rename(coldir)
+        except OSError:
+            # Another process converted the catalogue in the meantime
+            shutil.rmtree(tmpdir)
+
+    def where(self, condition: Union[str, Callable]) -> np.ndarray:
+        """
+        Return the sorted indices of the blends matching a condition
+
+        The condition is either an expression on the catalogue columns,
+        e.g. "distance < 10 and g1_type == 'disk'", or a callable taking
+        the dictionary of columns and returning a boolean array.
+        """
+        return evaluate_condition(self.columns, condition)
+
+    def take(self, indices: Sequence[int],
+             products: Optional[Sequence[str]] = None,
+             max_gap: int = 0) -> Dict[str, np.ndarray]:
+        """
+        Read the catalogue entries and the products of the given blends
+
+        Parameters
+        ----------
+        indices:
+            indices of the blends, as returned by `where`
+        products: default all
+            names of the stacked arrays to read
+        max_gap: default 0
+            largest number of unneeded rows read to merge two ranges
+
+        Returns
+        -------
+        dictionary of the catalogue columns and products, in the order of
+        the sorted indices, the blends and single images as float32
+
+        """
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        if products is None:
+            products = self.products
+
+        subset = {name: column[indices] for name, column in self.columns.items()}
+        for product in products:
+            subset[product] = read_rows(self.array(product), indices,
+                                        max_gap=max_gap)
+            if product in IMAGE_PRODUCTS:
+                # Images stored with a reduced precision come back as float32
+                subset[product] = dequantise(subset[product],
+                                             subset.get(f"{product}_scale"),
+                                             subset.get(f"{product}_offset"),
+                                             product)
+        return subset
+
+    def batches(self, batch_size: int, products: Optional[Sequence[str]] = None,
+                indices: Optional[Sequence[int]] = None,
+                max_gap: int = 0) -> Iterator[Dict[str, np.ndarray]]:
+        """
+        Iterate over the blends by batches of `batch_size`, as returned by
+        `take`, by default over the whole split
+        """
+        indices = np.arange(len(self)) if indices is None else np.unique(indices)
+        for start in range(0, len(indices), batch_size):
+            yield self.take(indices[start:start + batch_size], products=products,
+                            max_gap=max_gap)
+
+    def query(self, condition: Union[str, Callable],
+              products: Optional[Sequence[str]] = None,
+              max_gap: int = 0) -> Dict[str, np.ndarray]:
+        """Shortcut for `take(where(condition), products)`"""
+        return self.take(self.where(condition), products=products,
+                         max_gap=max_gap)
@@ -0,0 +1,317 @@
+"""
+Prepared binary library of the input galaxies.
+
+Building a `Blender` parses the CSV catalogue, loads and casts both stamp
+arrays and applies the catalogue cuts. The library stores the result of
+that work once, as a directory of `.npy` files that are opened with
+memory-mapping: later `Blender` instances start almost instantly and
+concurrent processes share the same pages.
+
+The library directory contains
+  - `stamps.npy`: the galaxy stamps cast to `Blender.img_dtype`
+  - `segmaps.npy`: the segmentation maps cast to `Blender.seg_dtype`
+  - `clean_segs.npy`: the segmentation maps of the central galaxies only
+  - `neighbours.npy`: the dilated masks of the neighbours to fill in
+  - `background_std.npy`: the background noise level of each stamp
+  - `cat_<column>.npy`: one file per catalogue column
+  - `meta.json`: the description of the content
+
+and lives in a sub-directory of the cache named after a hash of the input
+files and of the cut parameters.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Sequence, Tuple, Union
+
+import numpy as np  # type: ignore
+
+from blender.segmap import background_noise_std, neighbour_masks
+
+PathType = Union[Path, str]
+
+LIBRARY_VERSION = 1
+META_FILE = "meta.json"
+
+
+def select_galaxies(cat, mag_low: float = 0, mag_high: float = 100,
+                    excluded_type: Sequence[str] = ()) -> List[np.ndarray]:
+    """
+    Return the successive boolean selections applied by the catalogue cuts
+
+    The cuts are the ones of `candels-blender produce`, each selection
+    applying to the catalogue left by the previous ones.
+    """
+    selections = []
+    for logic in ("mag_low", "mag_high", *sorted(set(excluded_type))):
+        if logic == "mag_low":
+            selection = cat.mag.values > mag_low
+        elif logic == "mag_high":
+            selection = cat.mag.values < mag_high
+        else:
+            selection = cat.galtype.values != logic
+        cat = cat[selection].reset_index(drop=True)
+        selections.append(selection)
+
+    return selections
+
+
+def library_key(imgpath: PathType, segpath: PathType, catpath: PathType,
+                **cuts) -> str:
+    """
+    Hash identifying a library from its input files and cut parameters
+
+    The input files are identified by their absolute path, size and
+    modification time, which avoids reading them to compute the key.
+    """
+    description = {"version": LIBRARY_VERSION, "cuts": cuts, "files": []}
+    for path in (imgpath, segpath, catpath):
+        path = Path(path).resolve()
+        stat = path.stat()
+        description["files"].append([str(path), stat.st_size, stat.st_mtime_ns])
+
+    content = json.dumps(description, sort_keys=True, default=list)
+    return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+
+def load_inputs(imgpath: PathType, segpath: PathType,
+                catpath: PathType) -> Dict[str, Any]:
+    """
+    Load the input stamps, segmaps and catalogue with the Blender dtypes
+
+    Returns a dictionary with the `stamps`, `segmaps` and `cat` entries.
+    """
+    import pandas as pd  # type: ignore
+    from blender.blender import Blender
+
+    return {
+        "stamps": np.load(imgpath).astype(Blender.img_dtype, copy=False),
+        "segmaps": np.load(segpath).astype(Blender.seg_dtype, copy=False),
+        "cat": pd.read_csv(catpath),
+    }
+
+
+def galaxy_masks(stamps: np.ndarray, segmaps: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Precompute the masks used by `Blender.masked_stamp` for every galaxy
+
+    Returns a dictionary with
+      - `clean_segs`: the segmentation maps of the central galaxies only
+      - `neighbours`: the dilated masks of the neighbours to fill in
+      - `background_std`: the background noise level of each stamp
+    """
+    center = stamps.shape[-1] // 2
+    clean_segs = np.empty_like(segmaps)
+    neighbours = np.empty(segmaps.shape, dtype=bool)
+    background_std = np.empty(len(stamps), dtype=stamps.dtype)
+    for idx in range(len(stamps)):
+        segval = segmaps[idx, center, center]
+        clean_segs[idx] = np.where(segmaps[idx] == segval, 1, 0)
+        background_mask, neighbours[idx] = neighbour_masks(segmaps[idx], segval)
+        background_std[idx] = background_noise_std(stamps[idx], background_mask)
+
+    return {
+        "clean_segs": clean_segs,
+        "neighbours": neighbours,
+        "background_std": background_std,
+    }
+
+
+def apply_cuts(arrays: Dict[str, Any], mag_low: float = 0,
+               mag_high: float = 100, excluded_type: Sequence[str] = ()
+               ) -> Tuple[Dict[str, Any], List[int]]:
+    """
+    Select the galaxies passing the catalogue cuts
+
+    Parameters
+    ----------
+    arrays:
+        per-galaxy arrays, including the catalogue under the `cat` key
+    mag_low, mag_high:
+        magnitude range of the selected galaxies
+    excluded_type:
+        galaxy types to exclude
+
+    Returns
+    -------
+    arrays:
+        the selected entries of the input arrays
+    n_gal_history:
+        number of galaxies before the cuts and after each of them
+
+    """
+    n_gal_history = [len(arrays["cat"])]
+    for selection in select_galaxies(arrays["cat"], mag_low, mag_high,
+                                     excluded_type):
+        arrays = {
+            name: (array[selection].reset_index(drop=True) if name == "cat"
+                   else array[selection])
+            for name, array in arrays.items()
+        }
+        n_gal_history.append(len(arrays["cat"]))
+
+    return arrays, n_gal_history
+
+
+def open_npy(path: PathType, dtype, shape: Tuple[int, ...]) -> BinaryIO:
+    """
+    Create a .npy file of the given dtype and shape and return it opened
+    for the rows to be appended in order
+    """
+    f = open(path, "wb")
+    np.lib.format.write_array_header_1_0(f, {
+        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        "fortran_order": False,
+        "shape": shape,
+    })
+    return f
+
+
+def prepare_library(imgpath: PathType, segpath: PathType, catpath: PathType,
+                    cachedir: PathType, mag_low: float = 0,
+                    mag_high: float = 100,
+                    excluded_type: Sequence[str] = (),
+                    chunk_size: int = 256) -> Path:
+    """
+    Create the library of the input galaxies, unless already in the cache
+
+    Parameters
+    ----------
+    imgpath, segpath, catpath:
+        input stamps, segmaps and catalogue
+    cachedir:
+        directory hosting the libraries
+    mag_low, mag_high:
+        magnitude range of the selected galaxies
+    excluded_type:
+        galaxy types to exclude
+    chunk_size: default 256
+        number of galaxies read and masked at once, bounding the memory
+        used to build the library
+
+    Returns
+    -------
+    path to the library directory
+
+    """
+    import pandas as pd  # type: ignore
+    from blender.blender import Blender
+
+    cuts = dict(mag_low=mag_low, mag_high=mag_high,
+                excluded_type=sorted(set(excluded_type)))
+    key = library_key(imgpath, segpath, catpath, **cuts)
+    libdir = Path(cachedir) / key
+    if (libdir / META_FILE).exists():
+        return libdir
+
+    cat = pd.read_csv(catpath)
+    selected = np.arange(len(cat))
+    n_gal_history = [len(cat)]
+    for selection in select_galaxies(cat, **cuts):
+        selected = selected[selection]
+        n_gal_history.append(len(selected))
+    cat = cat.iloc[selected].reset_index(drop=True)
+
+    # Write in a temporary directory first so that concurrent processes
+    # never see a partial library
+    tmpdir = Path(cachedir) / f".{key}-{os.getpid()}"
+    tmpdir.mkdir(parents=True, exist_ok=True)
+
+    # The stamps are read, masked and written by chunks of galaxies so that
+    # the inputs never need to fit in memory. The inputs are mapped for one
+    # chunk at a time and the outputs written sequentially, keeping their
+    # pages out of the resident memory.
+    shape = (len(selected), *np.load(imgpath, mmap_mode="r").shape[1:])
+    outputs = {
+        name: open_npy(tmpdir / f"{name}.npy", dtype, shape)
+        for name, dtype in (("stamps", Blender.img_dtype),
+                            ("segmaps", Blender.seg_dtype),
+                            ("clean_segs", Blender.seg_dtype),
+                            ("neighbours", bool))
+    }
+    background_std = np.empty(len(selected), dtype=Blender.img_dtype)
+    with contextlib.ExitStack() as stack:
+        for output in outputs.values():
+            stack.enter_context(output)
+        for start in range(0, len(selected), chunk_size):
+            rows = selected[start:start + chunk_size]
+            chunk = {
+                "stamps": np.load(imgpath, mmap_mode="r")[rows].astype(
+                    Blender.img_dtype, copy=False),
+                "segmaps": np.load(segpath, mmap_mode="r")[rows].astype(
+                    Blender.seg_dtype, copy=False),
+            }
+            chunk.update(galaxy_masks(chunk["stamps"], chunk["segmaps"]))
+            for name, output in outputs.items():
+                output.write(np.ascontiguousarray(chunk[name]).tobytes())
+            background_std[start:start + len(rows)] = chunk["background_std"]
+
+    arrays = {"background_std": background_std}
+    for column in cat.columns:
+        values = cat[column].to_numpy()
+        if values.dtype.kind == "O":
+            # Strings are stored with a fixed width to be memory-mappable
+            values = values.astype(str)
+        arrays[f"cat_{column}"] = values
+    for name, array in arrays.items():
+        np.save(tmpdir / f"{name}.npy", np.ascontiguousarray(array))
+
+    meta = {
+        "version": LIBRARY_VERSION,
+        "inputs": [str(Path(path).resolve()) for path in (imgpath, segpath, catpath)],
+        "cuts": cuts,
+        "columns": list(cat.columns),
+        "n_gal_history": n_gal_history,
+    }
+    with open(tmpdir / META_FILE, "w") as f:
+        json.dump(meta, f, indent=2)
+
+    try:
+        tmpdir.rename(libdir)
+    except OSError:
+        # Another process created the library in the meantime
+        shutil.rmtree(tmpdir)
+
+    return libdir
+
+
+def load_library(libdir: PathType) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Open the arrays of a library with memory-mapping
+
+    Returns
+    -------
+    arrays:
+        the library arrays, with the catalogue as a pandas DataFrame
+        under the `cat` key
+    meta:
+        the library description
+
+    """
+    import pandas as pd  # type: ignore
+
+    libdir = Path(libdir)
+    with open(libdir / META_FILE) as f:
+        meta = json.load(f)
+
+    if meta["version"] != LIBRARY_VERSION:
+        raise ValueError(
+            f"Library {libdir} has version {meta['version']}, "
+            f"expected {LIBRARY_VERSION}. Please prepare it again.")
+
+    def load(name):
+        return np.load(libdir / f"{name}.npy", mmap_mode="r")
+
+    arrays = {
+        name: load(name)
+        for name in ("stamps", "segmaps", "clean_segs", "neighbours", "background_std")
+    }
+    arrays["cat"] = pd.DataFrame({
+        column: np.asarray(load(f"cat_{column}"))
+        for column in meta["columns"]
+    })
+
+    return arrays, meta
@@ -0,0 +1,255 @@
+"""
+Memory planning of the `produce` and `concatenate` commands.
+
+The planners estimate the peak memory footprint of a run from the shape
+and dtype of the inputs, without loading them, and pick the settings
+keeping it under a given budget: in-memory or memory-mapped inputs,
+batch and queue sizes for `produce`, in-memory or streamed outputs and
+flush interval for `concatenate`, number of shards written at once for
+`concatenate --format shards`.
+"""
+import os
+import re
+from typing import Any, Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np  # type: ignore
+
+from blender.core import Stamp
+
+MemoryPlan = NamedTuple(
+    "MemoryPlan",
+    [
+        ("budget", int),
+        ("items", List[Tuple[str, int]]),
+        ("settings", Dict[str, Any]),
+    ],
+)
+
+UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+# Full-frame temporaries alive at once while masking and blending a galaxy
+# with the reference implementation (copies, noise fields, padded arrays)
+BLEND_TEMPORARIES = 12
+# Bytes per pixel of a galaxy while building the library, on top of the
+# inputs (cast stamp and segmap, cleaned segmap, neighbour mask)
+LIBRARY_PIXEL_BYTES = 8
+# Copies of the (B, K, N, N) stamps made by the vectorised compositor
+BATCH_COPIES = 4
+# Float64 copies of the (B, K, N, N) stamps while computing the overlap
+# statistics of a batch
+STATISTICS_COPIES = 6
+
+
+class MemoryBudgetError(Exception):
+    pass
+
+
+def parse_size(text: str) -> int:
+    """Parse a memory size such as '512M', '8G' or '1.5GB' into bytes"""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)i?B?\s*", text.upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size {text!r}")
+    value, unit = match.groups()
+    return int(float(value) * UNITS[unit])
+
+
+def physical_memory() -> int:
+    """Total physical memory of the machine, used as default budget"""
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):  # pragma: no cover
+        return 8 * UNITS["G"]
+
+
+def format_size(nbytes: int) -> str:
+    for unit in ("T", "G", "M", "K"):
+        if abs(nbytes) >= UNITS[unit]:
+            return f"{nbytes / UNITS[unit]:.1f} {unit}B"
+    return f"{nbytes} B"
+
+
+def format_plan(plan: MemoryPlan) -> str:
+    """Human readable description of a plan"""
+    peak = plan_peak(plan)
+    lines = [f"Memory budget: {format_size(plan.budget)}"]
+    lines += [f"  {name:<40s} {format_size(nbytes):>10s}"
+              for name, nbytes in plan.items]
+    lines.append(f"  {'estimated peak':<40s} {format_size(peak):>10s}")
+    lines.append("Settings:")
+    lines += [f"  {name}: {value}" for name, value in plan.settings.items()]
+    return "\n".join(lines)
+
+
+def plan_peak(plan: MemoryPlan) -> int:
+    return sum(nbytes for _, nbytes in plan.items)
+
+
+def array_info(path) -> Tuple[Tuple[int, ...], np.dtype]:
+    """Shape and dtype of a .npy file, read from its header only"""
+    array = np.load(path, mmap_mode="r")
+    return array.shape, array.dtype
+
+
+def nbytes_of(shape: Sequence[int], dtype) -> int:
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+
+def plan_produce(budget: int, imgpath, segpath, n_gal: int = 2,
+                 batch_size: int = 64, n_writers: int = 4,
+                 noise: str = "strict", use_library: bool = False,
+                 share_masks: bool = False) -> MemoryPlan:
+    """
+    Plan the memory of `candels-blender produce`
+
+    The inputs are kept in memory when they fit in half of the budget,
+    otherwise they are read from a memory-mapped library, built by chunks
+    of galaxies within a quarter of the budget. The rest of the
+    budget goes to the batches of blends and to the queue of blends
+    waiting to be written.
+
+    With `share_masks`, the galaxy masks of all the inputs are also kept
+    in memory, as for the configurations of a sweep.
+
+    Raises `MemoryBudgetError` when even one blend at a time cannot fit.
+    """
+    from blender.blender import Blender
+    from blender.noise import NoiseBank
+
+    img_shape, img_dtype = array_info(imgpath)
+    seg_shape, seg_dtype = array_info(segpath)
+    n_input, size = img_shape[0], img_shape[-1]
+    frame = size * size
+
+    # Loading reads the arrays with their stored dtype then casts them
+    inputs = 0
+    for shape, stored, dtype in ((img_shape, img_dtype, Blender.img_dtype),
+                                 (seg_shape, seg_dtype, Blender.seg_dtype)):
+        inputs += nbytes_of(shape, dtype)
+        if stored != dtype:
+            inputs += nbytes_of(shape, stored)
+    if share_masks:
+        # Cleaned segmaps and boolean neighbour masks
+        inputs += 2 * n_input * frame
+    catalogue = n_input * 512
+
+    items: List[Tuple[str, int]] = []
+    library_chunk = None
+    if not use_library and inputs <= budget // 2:
+        items.append(("input stamps and segmaps", inputs))
+    else:
+        use_library = True
+        # The library is built by chunks of galaxies read from the inputs,
+        # then memory-mapped
+        per_galaxy = (nbytes_of(img_shape[1:], img_dtype)
+                      + nbytes_of(seg_shape[1:], seg_dtype)
+                      + LIBRARY_PIXEL_BYTES * frame)
+        library_chunk = int(np.clip(budget // 4 // per_galaxy, 1, 256))
+        items.append((f"input library, built by {library_chunk} galaxies",
+                      library_chunk * per_galaxy))
+    items.append(("input catalogue", catalogue))
+    if noise == "bank":
+        items.append(("noise bank", nbytes_of((2048, 2048), NoiseBank.dtype)))
+
+    blend_bytes = n_gal * frame * (np.dtype(Blender.img_dtype).itemsize
+                                   + np.dtype(Blender.seg_dtype).itemsize)
+    blending_bytes = BLEND_TEMPORARIES * frame * 8
+    remaining = budget - plan_peak(MemoryPlan(budget, items, {})) - blending_bytes
+    if remaining < 2 * blend_bytes:
+        raise MemoryBudgetError(
+            f"A budget of {format_size(budget)} is too small, at least "
+            f"{format_size(budget - remaining + 2 * blend_bytes)} are needed")
+
+    settings: Dict[str, Any] = {"use_library": use_library}
+    if library_chunk is not None:
+        settings["library_chunk_size"] = library_chunk
+    items.append(("blending temporaries", blending_bytes))
+
+    per_blend = STATISTICS_COPIES * n_gal * frame * 8
+    per_blend += (BATCH_COPIES if n_gal > 2 else 1) * blend_bytes
+    batch_size = int(np.clip(remaining // 2 // per_blend, 1, batch_size))
+    settings["batch_size"] = batch_size
+    items.append((f"batches of {batch_size} blends", batch_size * per_blend))
+    remaining -= batch_size * per_blend
+
+    max_pending = int(np.clip(remaining // blend_bytes, 1, max(8 * n_writers, 1)))
+    settings["max_pending"] = max_pending
+    items.append((f"write queue of {max_pending} blends", max_pending * blend_bytes))
+
+    return MemoryPlan(budget, items, settings)
+
+
+def plan_concatenate(budget: int, n_img: int, row_shapes: Dict[str, Stamp],
+                     source_bytes: int, n_jobs: int = 1) -> MemoryPlan:
+    """
+    Plan the memory of `candels-blender concatenate` for one split
+
+    Parameters
+    ----------
+    budget:
+        memory budget in bytes
+    n_img:
+        number of individual blends
+    row_shapes:
+        mapping of the product names to an example output row
+    source_bytes:
+        size of the individual files read for one blend
+    n_jobs:
+        number of reading threads
+
+    The output stacks are kept in memory when they fit in the budget,
+    otherwise they are streamed to memory-mapped files and flushed to disk
+    every `chunk_size` blends.
+    """
+    row_bytes = sum(row.nbytes for row in row_shapes.values())
+    readers = max(n_jobs, 1) * 2 * (source_bytes + row_bytes)
+    stacks = n_img * row_bytes
+
+    items = [(f"{max(n_jobs, 1)} reading threads", readers)]
+    remaining = budget - readers
+    if remaining < row_bytes:
+        raise MemoryBudgetError(
+            f"A budget of {format_size(budget)} is too small, at least "
+            f"{format_size(readers + row_bytes)} are needed")
+
+    if stacks <= remaining:
+        items.append(("output stacks", stacks))
+        settings: Dict[str, Any] = {"stream": False, "chunk_size": n_img}
+    else:
+        chunk_size = int(max(remaining // row_bytes, 1))
+        items.append((f"dirty pages of {chunk_size} blends", chunk_size * row_bytes))
+        settings = {"stream": True, "chunk_size": chunk_size}
+
+    return MemoryPlan(budget, items, settings)
+
+
+def plan_shards(budget: int, n_img: int, shard_size: int,
+                row_shapes: Dict[str, Stamp], source_bytes: int,
+                n_jobs: int = 1) -> MemoryPlan:
+    """
+    Plan the memory of `candels-blender concatenate --format shards` for one
+    split, see `plan_concatenate` for the parameters
+
+    Each thread builds a whole shard in memory, so the plan of
+    `plan_concatenate` applies to `n_jobs` shards at once. The number of
+    shards written concurrently is lowered until they fit in the budget.
+
+    Raises `MemoryBudgetError` when a single shard does not fit.
+    """
+    shard_rows = min(shard_size, n_img)
+    for n_shards in range(max(n_jobs, 1), 0, -1):
+        try:
+            plan = plan_concatenate(budget, n_shards * shard_rows, row_shapes,
+                                    source_bytes, n_jobs=n_shards)
+        except MemoryBudgetError:
+            continue
+        if not plan.settings["stream"]:
+            readers, stacks = plan.items
+            return MemoryPlan(budget, [
+                readers,
+                (f"{n_shards} shards of {shard_rows} blends", stacks[1]),
+            ], {"n_jobs": n_shards})
+
+    raise MemoryBudgetError(
+        f"A shard of {shard_rows} blends does not fit in a budget of "
+        f"{format_size(budget)}, use a smaller --shard_size")
+
@@ -0,0 +1,77 @@
+from typing import Optional, Tuple
+
+import numpy as np  # type: ignore
+from numpy.random import RandomState
+
+from blender.core import Stamp
+
+
+class NoiseBank:
+    """
+    Source of Gaussian background noise for the stamps.
+
+    Drawing two full stamps of Gaussian noise per galaxy is the most
+    expensive part of the masking. The bank instead generates a large
+    float32 standard normal field once and returns random tiles of it,
+    randomly flipped and transposed, scaled to the requested noise level.
+
+    In strict mode, no bank is generated and every call is a fresh draw
+    from `np.random.normal`, as done originally.
+
+    Parameters
+    ----------
+    size:
+        side of the square bank of standard normal samples
+    seed:
+        seed of the bank content and of the tile selection
+    strict:
+        use fresh independent draws instead of the bank
+
+    """
+    dtype = np.float32
+
+    def __init__(self, size: int = 2048, seed: Optional[int] = None,
+                 strict: bool = False) -> None:
+        self.strict = strict
+        self.rng = RandomState(seed=seed)
+        self.bank: Optional[Stamp] = None
+        if not strict:
+            self.bank = self.rng.standard_normal((size, size)).astype(self.dtype)
+            self.bank.flags.writeable = False
+
+    def draw(self, shape: Tuple[int, int], scale: float) -> Stamp:
+        """Return a (H, W) field of Gaussian noise of std `scale`"""
+        if self.bank is None:
+            return np.random.normal(scale=scale, size=shape)
+
+        return self.dtype(scale) * self.standard(shape)
+
+    def standard(self, shape: Tuple[int, int]) -> Stamp:
+        """
+        Return a (H, W) field of standard normal noise
+
+        With the bank, the field is a read-only view of the bank, so no
+        memory is allocated. The random numbers consumed are the same as
+        for `draw`.
+        """
+        if self.bank is None:
+            return np.random.standard_normal(size=shape)
+
+        height, width = shape
+        if self.bank.shape[0] < max(height, width):
+            raise ValueError(
+                f"The noise bank of size {self.bank.shape[0]} is too small "
+                f"for stamps of shape {shape}")
+
+        flip_y, flip_x, transpose = self.rng.randint(0, 2, size=3)
+        y0, x0 = self.rng.randint(0, self.bank.shape[0] - max(height, width) + 1,
+                                  size=2)
+        tile = self.bank[y0:y0 + height, x0:x0 + width]
+        if flip_y:
+            tile = tile[::-1]
+        if flip_x:
+            tile = tile[:, ::-1]
+        if transpose and height == width:
+            tile = tile.T
+
+        return tile
@@ -0,0 +1,139 @@
+"""
+Reduced-precision storage of the image products.
+
+The blends and single images can be stored as
+
+  - `float32`: the default, without loss
+  - `float16`: half precision, with a relative error of about 5e-4
+  - `int16`: integers with one scale and one offset per blend, stored in
+    the catalogue as the `<product>_scale` and `<product>_offset` columns
+
+The stored values are turned back into float32 by `dequantise`, on
+vectorised batches. The quantisation error is reported relative to the
+background noise of each blend, measured on the pixels outside of all
+the galaxy segmaps, to check that it stays well below the noise floor.
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np  # type: ignore
+
+from blender.core import Stamp
+
+PRECISIONS = ("float32", "float16", "int16")
+IMAGE_PRODUCTS = ("blends", "single_images")
+INT16_MAX = 32767
+
+
+def storage_dtype(precision: str) -> np.dtype:
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    return np.dtype(precision)
+
+
+def quantise(rows: Stamp, precision: str = "float32") -> Tuple[Stamp, Optional[np.ndarray],
+                                                               Optional[np.ndarray]]:
+    """
+    Convert a batch of images of shape (B, ...) to the storage precision
+
+    Returns
+    -------
+    stored:
+        the converted images
+    scale, offset:
+        (B,) arrays such that `stored * scale + offset` approximates the
+        images for int16, None otherwise
+
+    """
+    rows = np.asarray(rows)
+    if precision != "int16":
+        return rows.astype(storage_dtype(precision)), None, None
+
+    flat = rows.reshape(len(rows), -1).astype(np.float64)
+    low, high = flat.min(axis=1), flat.max(axis=1)
+    offset = (high + low) / 2
+    scale = (high - low) / (2 * INT16_MAX)
+    scale[scale == 0] = 1
+
+    stored = np.rint((flat - offset[:, None]) / scale[:, None])
+    stored = np.clip(stored, -INT16_MAX, INT16_MAX).astype(np.int16)
+    return stored.reshape(rows.shape), scale, offset
+
+
+def dequantise(stored: Stamp, scale: Optional[np.ndarray] = None,
+               offset: Optional[np.ndarray] = None, product: str = "images") -> Stamp:
+    """
+    Convert a batch of stored images of shape (B, ...) back to float32
+
+    `scale` and `offset` are the (B,) arrays returned by `quantise` for
+    int16 images, and are ignored for float images. `product` names the
+    images in the error raised when they are missing.
+    """
+    stored = np.asarray(stored)
+    if stored.dtype.kind == "f":
+        return stored.astype(np.float32, copy=False)
+
+    missing = [f"{product}_{name}" for name, values in
+               (("scale", scale), ("offset", offset)) if values is None]
+    if missing:
+        raise ValueError(
+            f"The {product} are stored as {stored.dtype}, their "
+            f"{' and '.join(missing)} catalogue column(s) are needed to "
+            "convert them back to float32")
+
+    expand = (slice(None),) + (None,) * (stored.ndim - 1)
+    scale = np.asarray(scale, dtype=np.float32)[expand]
+    offset = np.asarray(offset, dtype=np.float32)[expand]
+    return stored.astype(np.float32) * scale + offset
+
+
+def background_std(blends: Stamp, segmaps: Stamp) -> np.ndarray:
+    """
+    Background noise level of a batch of blends
+
+    Parameters
+    ----------
+    blends:
+        (B, N, N) blend images
+    segmaps:
+        (B, K, N, N) segmentation maps of the galaxies
+
+    Returns
+    -------
+    (B,) standard deviation of the pixels outside of all the segmaps
+
+    """
+    background = ~np.any(segmaps, axis=1)
+    n_pixels = np.maximum(background.sum(axis=(1, 2)), 1)
+    values = np.where(background, blends, 0).astype(np.float64)
+    mean = values.sum(axis=(1, 2)) / n_pixels
+    variance = (values ** 2).sum(axis=(1, 2)) / n_pixels - mean ** 2
+    return np.sqrt(np.maximum(variance, 0))
+
+
+def noise_relative_errors(rows: Stamp, stored: Stamp, scale: Optional[np.ndarray],
+                          offset: Optional[np.ndarray],
+                          noise_std: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantisation error of a batch of images in units of their background noise
+
+    Returns
+    -------
+    max_error:
+        (B,) largest absolute error of each image
+    sq_error:
+        (B,) sum of the squared errors of each image
+
+    """
+    error = dequantise(stored, scale, offset).astype(np.float64) - rows
+    error = error.reshape(len(rows), -1) / np.where(noise_std > 0, noise_std, 1)[:, None]
+    return np.abs(error).max(axis=1), (error ** 2).sum(axis=1)
+
+
+def summarise_errors(max_error: np.ndarray, sq_error: np.ndarray,
+                     values_per_row: int) -> Dict[str, float]:
+    """Maximum and RMS error over all the images, in units of the noise"""
+    n_values = max(len(sq_error) * values_per_row, 1)
+    return dict(
+        max=float(np.max(max_error, initial=0)),
+        rms=float(np.sqrt(np.sum(sq_error) / n_values)),
+    )
@@ -0,0 +1,403 @@
+"""
+Quota-based stratified sampling of the galaxy pairs and shifts.
+
+By default, the distribution of the blend properties follows from the
+random draws of `Blender.random_pair` and `Blender.random_shift`. A quota
+specification instead sets target histograms over
+
+  - `distance`: the distance between the galaxies, in pixels
+  - `magdiff`: the absolute difference of magnitude of the galaxies
+  - `galtypes`: the combination of galaxy types, e.g. "disk-sph", the
+    types being sorted alphabetically
+  - `z`: the redshift of the central galaxy
+
+given as a JSON object such as
+
+    {"distance": {"bins": [0, 5, 10, 20, 40]},
+     "magdiff": {"bins": [0, 0.5, 1, 1.5, 2], "weights": [4, 3, 2, 1]},
+     "galtypes": {"disk-disk": 1, "disk-sph": 1, "sph-sph": 1}}
+
+Numerical variables take bin edges and optional weights, flat by default;
+`galtypes` maps each combination to its weight. The joint target is the
+product of the marginal histograms, and the number of blends of each cell
+is allocated with the largest remainder method.
+
+Sampling works without rejection: all the pairs of galaxies of the split
+satisfying the magnitude constraint are enumerated once and grouped by
+cell, while the integer shifts of the stamp grid are sorted by distance,
+so that the shifts of a pair within a distance bin form a contiguous
+range. Every cell is filled by drawing uniformly among its eligible pairs
+and, for each, among its valid shifts.
+"""
+import json
+from itertools import product
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple, Union
+
+import numpy as np  # type: ignore
+
+QUOTA_VARIABLES = ("distance", "magdiff", "galtypes", "z")
+
+Quota = NamedTuple(
+    "Quota",
+    [
+        ("variable", str),
+        ("bins", List[Any]),
+        ("weights", np.ndarray),
+    ],
+)
+
+
+class QuotaError(Exception):
+    pass
+
+
+def parse_quotas(spec: Dict[str, Any]) -> List[Quota]:
+    """Validate a quota specification and return one `Quota` per variable"""
+    unknown = set(spec) - set(QUOTA_VARIABLES)
+    if unknown:
+        raise QuotaError(f"Unknown quota variables {sorted(unknown)}, "
+                         f"expected some of {list(QUOTA_VARIABLES)}")
+    if not spec:
+        raise QuotaError("The quota specification is empty")
+
+    quotas = []
+    for variable in QUOTA_VARIABLES:
+        if variable not in spec:
+            continue
+        entry = spec[variable]
+        if variable == "galtypes":
+            bins = ["-".join(sorted(label.split("-"))) for label in entry]
+            weights = np.array(list(entry.values()), dtype=float)
+        else:
+            bins = [float(edge) for edge in entry["bins"]]
+            if len(bins) < 2 or np.any(np.diff(bins) <= 0):
+                raise QuotaError(f"The bins of {variable} must be increasing "
+                                 "edges")
+            weights = np.array(entry.get("weights", [1] * (len(bins) - 1)),
+                               dtype=float)
+            if len(weights) != len(bins) - 1:
+                raise QuotaError(f"{variable} has {len(bins) - 1} bins but "
+                                 f"{len(weights)} weights")
+        if np.any(weights < 0) or weights.sum() <= 0:
+            raise QuotaError(f"The weights of {variable} must be positive")
+        quotas.append(Quota(variable, bins, weights / weights.sum()))
+
+    return quotas
+
+
+def load_quotas(filepath) -> List[Quota]:
+    with open(filepath) as f:
+        return parse_quotas(json.load(f))
+
+
+def allocate(n_blends: int, quotas: List[Quota]) -> Tuple[List[Tuple[int, ...]], np.ndarray]:
+    """
+    Split a number of blends between the cells of the joint histogram
+
+    Returns
+    -------
+    cells:
+        the bin index of each variable, for each cell
+    counts:
+        the number of blends of each cell, summing to `n_blends`
+
+    """
+    cells = list(product(*(range(len(quota.weights)) for quota in quotas)))
+    expected = n_blends * np.array([
+        np.prod([quota.weights[b] for quota, b in zip(quotas, cell)])
+        for cell in cells
+    ])
+    counts = np.floor(expected).astype(int)
+    remainder = n_blends - counts.sum()
+    counts[np.argsort(counts - expected, kind="stable")[:remainder]] += 1
+
+    return cells, counts
+
+
+def shift_grid(img_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Integer (dy, dx) shifts of a stamp, sorted by distance"""
+    half = img_size // 2
+    coords = np.arange(-half, half + 1)
+    offsets = np.stack(np.meshgrid(coords, coords, indexing="ij"), axis=-1)
+    offsets = offsets.reshape(-1, 2)
+    distances = np.hypot(offsets[:, 0], offsets[:, 1])
+    order = np.argsort(distances, kind="stable")
+    return offsets[order], distances[order]
+
+
+def shift_limits(rads1: np.ndarray, rads2: np.ndarray, raddiff: float,
+                 img_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorised distance range of the shifts, as in `Blender.random_shift`"""
+    rad_min = np.maximum(rads1, rads2)
+    rad_max = np.minimum(np.minimum(rads1, rads2) * raddiff, img_size // 2)
+    rad_min = np.where(rad_min >= rad_max, 0.8 * rad_max, rad_min)
+    return rad_min, rad_max
+
+
+def pair_table(blender, from_test: bool = False) -> Dict[str, np.ndarray]:
+    """
+    Enumerate the pairs of distinct galaxies of a split allowed by `magdiff`
+
+    Returns a dictionary of arrays with one entry per pair: the catalogue
+    indices `g1` and `g2`, the pair properties `magdiff`, `galtypes` and
+    `z`, and the `rad_min` and `rad_max` distance range of the shift, as
+    defined in `Blender.random_shift`. The pairs are sorted by `g1`, then
+    `g2`, in the order of the split.
+    """
+    pool = blender.split_indices(from_test)
+    mags = blender.cat.mag.to_numpy()[pool]
+    rads = blender.cat.radius.to_numpy()[pool]
+
+    # The partners of each galaxy form a range of the sorted magnitudes,
+    # slightly widened here and cut with the exact test below
+    by_mag = np.argsort(mags, kind="stable")
+    sorted_mags = mags[by_mag]
+    margin = 1e-9 * (1 + np.abs(mags).max(initial=0))
+    low = np.searchsorted(sorted_mags, mags - blender.magdiff - margin, side="left")
+    high = np.searchsorted(sorted_mags, mags + blender.magdiff + margin, side="right")
+    counts = high - low
+    g1 = np.repeat(np.arange(len(pool)), counts)
+    g2 = by_mag[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - low,
+                                                    counts)]
+    allowed = (np.abs(mags[g1] - mags[g2]) < blender.magdiff) & (g1 != g2)
+    g1, g2 = g1[allowed], g2[allowed]
+    order = np.lexsort((g2, g1))
+    g1, g2 = g1[order], g2[order]
+    rad_min, rad_max = shift_limits(rads[g1], rads[g2], blender.raddiff,
+                                    blender.img_size)
+
+    types = blender.cat.galtype.to_numpy().astype(str)[pool]
+    swap = types[g1] > types[g2]
+    first = np.where(swap, types[g2], types[g1])
+    second = np.where(swap, types[g1], types[g2])
+
+    return dict(
+        g1=pool[g1],
+        g2=pool[g2],
+        magdiff=np.abs(mags[g1] - mags[g2]),
+        galtypes=np.char.add(np.char.add(first, "-"), second),
+        z=blender.cat.z.to_numpy()[pool][g1],
+        rad_min=rad_min,
+        rad_max=rad_max,
+    )
+
+
+def bin_pairs(pairs: Dict[str, np.ndarray], quota: Quota) -> np.ndarray:
+    """Bin index of each pair for a pair-level variable, -1 outside the bins"""
+    if quota.variable == "galtypes":
+        labels = np.array(quota.bins)
+        matches = pairs["galtypes"][:, None] == labels[None, :]
+        return np.where(matches.any(axis=1), matches.argmax(axis=1), -1)
+
+    edges = np.asarray(quota.bins)
+    bins = np.searchsorted(edges, pairs[quota.variable], side="right") - 1
+    return np.where(bins < len(edges) - 1, bins, -1)
+
+
+def shift_ranges(pairs: Dict[str, np.ndarray], distances: np.ndarray,
+                 low: float = 0, high: float = np.inf) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Range [start, stop) of the sorted grid shifts valid for each pair and
+    within the distance bin [low, high)
+    """
+    start = np.searchsorted(distances, np.maximum(pairs["rad_min"], low), side="left")
+    stop = np.minimum(np.searchsorted(distances, pairs["rad_max"], side="right"),
+                      np.searchsorted(distances, high, side="left"))
+    return start, np.maximum(stop, start)
+
+
+PairIndex = NamedTuple(
+    "PairIndex",
+    [
+        ("quotas", List[Quota]),
+        ("from_test", bool),
+        ("pairs", Dict[str, np.ndarray]),
+        ("cell_ids", np.ndarray),
+        ("bounds", np.ndarray),
+        ("members", np.ndarray),
+    ],
+)
+
+
+def index_pairs(blender, quotas: Union[List[Quota], Dict[str, Any]],
+                from_test: bool = False) -> PairIndex:
+    """
+    Enumerate the pairs of a split once and group them by cell
+
+    Every pair gets the flat index of its bins of the pair-level variables,
+    and the pairs are sorted once by that index, so that the pairs of the
+    cell `cell_ids[i]` are `members[bounds[i]:bounds[i + 1]]`, in the order
+    of the pair table. The pairs outside of the bins are left out.
+    """
+    if isinstance(quotas, dict):
+        quotas = parse_quotas(quotas)
+    pairs = pair_table(blender, from_test)
+
+    pair_quotas = [quota for quota in quotas if quota.variable != "distance"]
+    bins = np.empty((len(pair_quotas), len(pairs["g1"])), dtype=int)
+    for row, quota in enumerate(pair_quotas):
+        bins[row] = bin_pairs(pairs, quota)
+    inside = np.all(bins >= 0, axis=0)
+    pair_ids = np.full(len(pairs["g1"]), -1)
+    pair_ids[inside] = np.ravel_multi_index(
+        tuple(bins[:, inside]), [len(quota.weights) for quota in pair_quotas])
+
+    order = np.argsort(pair_ids, kind="stable")
+    order = order[pair_ids[order] >= 0]
+    cell_ids, first = np.unique(pair_ids[order], return_index=True)
+    bounds = np.append(first, len(order))
+
+    return PairIndex(quotas, from_test, pairs, cell_ids, bounds, order)
+
+
+def as_pair_index(blender, quotas: Union[PairIndex, List[Quota], Dict[str, Any]],
+                  from_test: bool = False) -> PairIndex:
+    """Return the pair index of a split, built from the quotas if needed"""
+    if not isinstance(quotas, PairIndex):
+        return index_pairs(blender, quotas, from_test)
+    if quotas.from_test != from_test:
+        raise ValueError("The pair index was built for the "
+                         f"{'test' if quotas.from_test else 'train'} split")
+    return quotas
+
+
+def cell_candidates(index: PairIndex, n_blends: int,
+                    img_size: int) -> Iterator[Tuple[Dict[str, int], int, Dict[str, np.ndarray]]]:
+    """
+    Yield the cells with a non-zero quota along with their number of
+    blends and their candidates: the pairs of the cell with at least one
+    valid shift, with their `start` and `stop` range in the shift grid.
+    """
+    _, distances = shift_grid(img_size)
+    quotas = index.quotas
+    pair_quotas = [quota for quota in quotas if quota.variable != "distance"]
+    shape = [len(quota.weights) for quota in pair_quotas]
+
+    cells, counts = allocate(n_blends, quotas)
+    for cell, count in zip(cells, counts):
+        if count == 0:
+            continue
+        bins = dict(zip((quota.variable for quota in quotas), cell))
+        cell_id = np.ravel_multi_index(
+            tuple(bins[quota.variable] for quota in pair_quotas), shape)
+        position = np.searchsorted(index.cell_ids, cell_id)
+        members = index.members[:0]
+        if position < len(index.cell_ids) and index.cell_ids[position] == cell_id:
+            members = index.members[index.bounds[position]:index.bounds[position + 1]]
+        candidates = {name: values[members] for name, values in index.pairs.items()}
+
+        low, high = 0.0, np.inf
+        if "distance" in bins:
+            edges = quotas[[quota.variable for quota in quotas].index("distance")].bins
+            low, high = edges[bins["distance"]], edges[bins["distance"] + 1]
+        start, stop = shift_ranges(candidates, distances, low, high)
+
+        eligible = stop > start
+        candidates = {name: values[eligible] for name, values in candidates.items()}
+        candidates.update(start=start[eligible], stop=stop[eligible])
+        yield bins, count, candidates
+
+
+def unfillable_cells(index: PairIndex, n_blends: int,
+                     img_size: int) -> List[Dict[str, int]]:
+    """Bins of the cells with a non-zero quota but no candidate pair"""
+    return [
+        bins
+        for bins, _, candidates in cell_candidates(index, n_blends, img_size)
+        if candidates["g1"].size == 0
+    ]
+
+
+def unfillable_error(cells: List[Dict[str, int]], from_test: bool) -> QuotaError:
+    split = "test" if from_test else "train"
+    return QuotaError(
+        f"No pair of {split} galaxies can fill the cells {cells[:5]}"
+        f"{' and more' if len(cells) > 5 else ''}, "
+        "set their weights to zero or loosen the cuts")
+
+
+def check_quotas(blender, quotas: Union[PairIndex, List[Quota], Dict[str, Any]],
+                 n_blends: int, from_test: bool = False) -> None:
+    """
+    Raise `QuotaError` if a cell with a non-zero quota cannot be filled
+
+    `quotas` may be the pair index of the split returned by `index_pairs`,
+    to share it with `sample_quotas`.
+    """
+    if n_blends == 0:
+        return
+    index = as_pair_index(blender, quotas, from_test)
+    empty = unfillable_cells(index, n_blends, blender.img_size)
+    if empty:
+        raise unfillable_error(empty, from_test)
+
+
+def sample_quotas(blender, quotas: Union[PairIndex, List[Quota], Dict[str, Any]],
+                  n_blends: int, from_test: bool = False,
+                  unique=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draw pairs of galaxies and their shifts filling the quotas
+
+    Parameters
+    ----------
+    blender:
+        the Blender instance, whose random state is used
+    quotas:
+        the pair index of the split returned by `index_pairs`, the parsed
+        quotas, or the raw specification
+    n_blends:
+        number of blends
+    from_test: default False
+        switch between the training and testing galaxy split
+    unique: optional
+        key set of `blender.uniqueness` holding the blends already drawn,
+        in which case every pair and shift is drawn at most once
+
+    Returns
+    -------
+    pairs:
+        (n_blends, 2) catalogue indices of the central and shifted galaxies
+    shifts:
+        (n_blends, 2) integer (dy, dx) shifts of the second galaxies
+
+    Raises `QuotaError` if a cell with a non-zero quota cannot be filled.
+    """
+    from blender.uniqueness import blend_keys
+
+    if n_blends == 0:
+        return np.empty((0, 2), dtype=int), np.empty((0, 2), dtype=int)
+    index = as_pair_index(blender, quotas, from_test)
+
+    cells = list(cell_candidates(index, n_blends, blender.img_size))
+    empty = [bins for bins, _, candidates in cells if candidates["g1"].size == 0]
+    if empty:
+        raise unfillable_error(empty, from_test)
+
+    offsets, _ = shift_grid(blender.img_size)
+    chosen_pairs, chosen_shifts = [], []
+    for bins, count, candidates in cells:
+        n_shifts = int((candidates["stop"] - candidates["start"]).sum())
+        if unique is not None and count > n_shifts:
+            raise QuotaError(f"The cell {bins} holds at most {n_shifts} unique "
+                             f"blends, {count} requested")
+
+        missing = count
+        while missing:
+            picked = blender.rng.randint(candidates["g1"].size, size=missing)
+            grid_idx = blender.rng.randint(candidates["start"][picked],
+                                           candidates["stop"][picked])
+            pairs = np.stack([candidates["g1"][picked], candidates["g2"][picked]],
+                             axis=1)
+            shifts = offsets[grid_idx]
+            if unique is not None:
+                keys = blend_keys(pairs, np.stack([np.zeros_like(shifts), shifts],
+                                                  axis=1))
+                new = unique.add(keys)
+                pairs, shifts = pairs[new], shifts[new]
+            chosen_pairs.append(pairs)
+            chosen_shifts.append(shifts)
+            missing -= len(pairs)
+
+    order = blender.rng.permutation(n_blends)
+    return (np.concatenate(chosen_pairs)[order],
+            np.concatenate(chosen_shifts)[order])
@@ -1,8 +1,8 @@
+import re
 from pathlib import Path
 
 import click
 import numpy as np
-import pandas as pd
 
 
 def mag2flux(mag, zp):
@@ -27,9 +27,11 @@ def main(image_dir, zeropoint):
     """Create an array with the flux of the blended galaxies.
 
     Takes the magnitudes from the blend catalogues found in <image_dir>
-    and uses the <zeropoint> to convert to flux.
+    and uses the <zeropoint> to convert to flux, one column per galaxy.
 
     """
+    import pandas as pd
+
     path = Path.cwd() / image_dir
 
     for prefix in ["train", "test"]:
@@ -37,10 +39,10 @@ def main(image_dir, zeropoint):
         output_file = path / f'{prefix}_flux.npy'
 
         df = pd.read_csv(catalog)
-        g1_flux = mag2flux(df.g1_mag.values, zp=zeropoint)
-        g2_flux = mag2flux(df.g2_mag.values, zp=zeropoint)
+        mag_columns = [col for col in df.columns if re.fullmatch(r"g\d+_mag", col)]
 
-        fluxes = [g1_flux[:, None], g2_flux[:, None]]
+        fluxes = [mag2flux(df[col].values, zp=zeropoint)[:, None]
+                  for col in mag_columns]
 
         flux_array = np.concatenate(fluxes, axis=-1)
 
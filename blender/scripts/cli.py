@@ -6,15 +6,41 @@ select one of the following actions:
 - `produce`: create the blends, masks and catalogues
 - `concatenate`: arrange the blends products into files
 - `convert`: create the flux table
+- `gallery`: render contact sheets of the blends
 """
+import importlib
+
 import click
 
-from blender.scripts import produce_blends
-from blender.scripts import concatenate_blends
-from blender.scripts import cat2flux
+# Subcommands are only imported when invoked, to keep the startup fast
+COMMANDS = {
+    "produce": "blender.scripts.produce_blends",
+    "concatenate": "blender.scripts.concatenate_blends",
+    "convert": "blender.scripts.cat2flux",
+    "gallery": "blender.scripts.gallery",
+}
+
+
+class LazyGroup(click.Group):
+    """Click group importing the module of a subcommand on demand"""
+
+    def list_commands(self, ctx):
+        return sorted(COMMANDS)
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in COMMANDS:
+            return None
+        module = importlib.import_module(COMMANDS[cmd_name])
+        return module.main
+
+    def format_commands(self, ctx, formatter):
+        # The action list is already given in the group help, which
+        # avoids importing every subcommand just to display `--help`
+        pass
 
 
 @click.group(
+    cls=LazyGroup,
     context_settings={"help_option_names": ["-h", "--help"]},
     help=__doc__,
 )
@@ -22,10 +48,5 @@ def cli():
     pass
 
 
-cli.add_command(produce_blends.main)
-cli.add_command(concatenate_blends.main)
-cli.add_command(cat2flux.main)
-
-
 if __name__ == "__main__":
-    cli()
\ No newline at end of file
+    cli()
@@ -1,11 +1,20 @@
+import csv
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Dict, Iterable, Optional, Tuple
 
 import click
 import numpy as np  # type: ignore
 
 from blender import segmap
+from blender.memory import MemoryBudgetError, format_plan, parse_size
+from blender.memory import physical_memory, plan_concatenate, plan_shards
+from blender.precision import IMAGE_PRODUCTS, PRECISIONS, background_std
+from blender.precision import noise_relative_errors, quantise, storage_dtype
+from blender.precision import summarise_errors
+from blender.shards import INDEX_FILE, write_shards
 
 IMG_TMP = "{prefix}_blend_{idx:06d}.npy"
 SEG_TMP = "{prefix}_blend_seg_{idx:06d}.npy"
@@ -13,80 +22,246 @@ IMG_DTYPE = np.float32
 SEG_DTYPE = np.uint8
 
 
-def concatenate_blends(n_img: int, filepath: Path, prefix: str) -> None:
+def _product_recipe(product: str, precision: str = "float32") -> Tuple[str, Callable, type]:
     """
-    Create a stack of blends from the individual images.
+    Return the source file template, the transformation applied to each
+    source file and the output dtype of a given product.
 
-    The individual files actually contain the images of the individual
-    galaxies that need to be sum up to obtain the blend. This method
-    takes care of this and can also output the individual galaxies as the
-    labels.
+    The image products are stored with the given precision, see
+    `blender.precision`.
+    """
+    img_dtype = IMG_DTYPE if precision == "float32" else storage_dtype(precision)
+    if product == "blends":
+        return IMG_TMP, lambda img: img.sum(axis=-1), img_dtype
+    if product == "single_images":
+        return IMG_TMP, lambda img: img, img_dtype
+    return SEG_TMP, getattr(segmap, product), SEG_DTYPE
+
+
+def add_catalogue_columns(catpath: Path, columns: Dict[str, np.ndarray]) -> None:
+    """
+    Add columns to a CSV catalogue, replacing the existing ones with the
+    same names and leaving the other columns untouched.
+    """
+    with open(catpath, newline="") as f:
+        header, *entries = list(csv.reader(f))
+
+    kept = [i for i, name in enumerate(header) if name not in columns]
+    with open(catpath, "w", newline="") as f:
+        output = csv.writer(f)
+        output.writerow([header[i] for i in kept] + list(columns))
+        for row, entry in enumerate(entries):
+            output.writerow([entry[i] for i in kept]
+                            + [repr(float(values[row])) for values in columns.values()])
+
+
+def product_rows(datadir: Path, prefix: str, products: Iterable[str],
+                 precision: str = "float32") -> Tuple[Dict[str, np.ndarray], int]:
+    """
+    Build the products of the first blend of a split
+
+    Returns
+    -------
+    rows:
+        mapping of the product names to their first row, giving the shape
+        and dtype of the stacks
+    source_bytes:
+        size of the individual files read for one blend
+
+    """
+    recipes = {product: _product_recipe(product, precision) for product in products}
+    templates = sorted({template for template, _, _ in recipes.values()})
+    sources = {
+        template: np.load(datadir / template.format(prefix=prefix, idx=0))
+        for template in templates
+    }
+    rows = {
+        product: builder(sources[template]).astype(dtype, copy=False)
+        for product, (template, builder, dtype) in recipes.items()
+    }
+    return rows, sum(source.nbytes for source in sources.values())
+
+
+def concatenate_products(n_img: int, datadir: Path, prefix: str,
+                         products: Dict[str, Path], n_jobs: int = 1,
+                         stream: bool = False,
+                         chunk_size: Optional[int] = None,
+                         precision: str = "float32") -> Dict[str, Dict[str, float]]:
+    """
+    Create several stacks of blends and targets in a single pass.
+
+    Each individual image and segmentation file is read exactly once and
+    dispatched to all the requested products, which avoids re-reading the
+    whole dataset for every target.
 
     Parameters
     ----------
-    path:
-        directory containing the individual image files
+    n_img:
+        number of individual blends
+    datadir:
+        directory containing the individual files
     prefix: {'train','test'}
         prefix of the image files corresponding to the split
-    with_labels:
-        saves the individual images as target
+    products:
+        mapping of the product names ('blends', 'single_images', or one of
+        the methods in `blender.segmap`) to their output file
+    n_jobs: default 1
+        number of threads reading the individual files concurrently
+    stream: default False
+        write the stacks to memory-mapped files instead of building them
+        in memory, for outputs larger than the available memory
+    chunk_size: optional
+        number of blends between two flushes of the memory-mapped files
+    precision: {'float32','float16','int16'}
+        storage precision of the blends and single images, the int16 scales
+        and offsets being added to the catalogue, see `blender.precision`
+
+    Returns
+    -------
+    the max and RMS quantisation errors of the reduced-precision products,
+    in units of the background noise
 
     """
-    datadir = filepath.parent
-    # Retrieving shape of images for the output
-    img0 = np.load(datadir / IMG_TMP.format(prefix=prefix, idx=0))
-
-    # Create placeholder for the images
-    imgmain = np.empty((n_img, *img0.shape[:-1]), dtype=img0.dtype)
+    if not products:
+        return {}
+
+    recipes = {product: _product_recipe(product, precision) for product in products}
+    quantised = [product for product in products
+                 if product in IMAGE_PRODUCTS and precision != "float32"]
+    templates = sorted({template for template, _, _ in recipes.values()}
+                       | ({IMG_TMP, SEG_TMP} if quantised else set()))
+
+    def load(template: str, idx: int) -> np.ndarray:
+        return np.load(datadir / template.format(prefix=prefix, idx=idx))
+
+    # Retrieving the shape of the outputs from the first files
+    rows, _ = product_rows(datadir, prefix, products, precision)
+    stacks = {}
+    for product, row in rows.items():
+        shape = (n_img, *row.shape)
+        if stream:
+            # Partial files are renamed once complete, so that an interrupted
+            # run is not mistaken for an existing product
+            stacks[product] = np.lib.format.open_memmap(
+                products[product].with_suffix(".npy.part"), mode="w+",
+                dtype=row.dtype, shape=shape)
+        else:
+            stacks[product] = np.empty(shape, dtype=row.dtype)
+
+    chunk_size = chunk_size or n_img
+    scales = {product: np.ones(n_img) for product in quantised}
+    offsets = {product: np.zeros(n_img) for product in quantised}
+    max_errors = {product: np.zeros(n_img) for product in quantised}
+    sq_errors = {product: np.zeros(n_img) for product in quantised}
+
+    def flush(n_done: int) -> None:
+        if stream and n_done % chunk_size == 0:
+            for stack in stacks.values():
+                stack.flush()
+
+    def process(idx: int) -> None:
+        sources = {template: load(template, idx) for template in templates}
+        if quantised:
+            noise_std = background_std(sources[IMG_TMP].sum(axis=-1)[None],
+                                       sources[SEG_TMP][None])
+        for product, (template, builder, _) in recipes.items():
+            row = builder(sources[template])
+            if product not in quantised:
+                stacks[product][idx] = row
+                continue
+            stored, scale, offset = quantise(row[None], precision)
+            stacks[product][idx] = stored[0]
+            if scale is not None:
+                scales[product][idx], offsets[product][idx] = scale[0], offset[0]
+            errors = noise_relative_errors(row[None], stored, scale, offset, noise_std)
+            max_errors[product][idx], sq_errors[product][idx] = errors[0][0], errors[1][0]
 
     # Load and process the images
-    msg = f"Processing the {prefix}ing blends"
-    with click.progressbar(range(n_img), label=msg) as bar:
-        for idx in bar:
-            img = np.load(datadir / IMG_TMP.format(prefix=prefix, idx=idx))
-            imgmain[idx] = img.sum(axis=-1)
-
-    np.save(filepath, imgmain.astype(IMG_DTYPE))
-
-
-def concatenate_single_images(n_img: int, filepath: Path, prefix: str):
+    msg = f"Processing the {prefix}ing {', '.join(products)}"
+    if n_jobs > 1:
+        # Each thread fills its own slice of the stacks, in any order
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool, \
+                click.progressbar(length=n_img, label=msg) as bar:
+            futures = [pool.submit(process, idx) for idx in range(n_img)]
+            for n_done, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                flush(n_done)
+                bar.update(1)
+    else:
+        with click.progressbar(range(n_img), label=msg) as bar:
+            for idx in bar:
+                process(idx)
+                flush(idx + 1)
+
+    for product, filepath in products.items():
+        if stream:
+            stacks[product].flush()
+            del stacks[product]
+            os.replace(filepath.with_suffix(".npy.part"), filepath)
+        else:
+            np.save(filepath, stacks[product])
+
+    if precision == "int16" and quantised:
+        columns = {}
+        for product in quantised:
+            columns[f"{product}_scale"] = scales[product]
+            columns[f"{product}_offset"] = offsets[product]
+        add_catalogue_columns(datadir / f"{prefix}_catalogue.csv", columns)
+
+    return {
+        product: summarise_errors(max_errors[product], sq_errors[product],
+                                  rows[product].size)
+        for product in quantised
+    }
+
+
+def concatenate_blends(n_img: int, filepath: Path, prefix: str,
+                       n_jobs: int = 1) -> None:
     """
     Create a stack of blends from the individual images.
 
     The individual files actually contain the images of the individual
-    galaxies that need to be sum up to obtain the blend. This method
-    takes care of this and can also output the individual galaxies as the
-    labels.
+    galaxies that need to be sum up to obtain the blend.
 
     Parameters
     ----------
-    path:
-        directory containing the individual image files
+    n_img:
+        number of individual blends
+    filepath:
+        output file, in the directory containing the individual image files
     prefix: {'train','test'}
         prefix of the image files corresponding to the split
-    with_labels:
-        saves the individual images as target
+    n_jobs: default 1
+        number of threads reading the individual files concurrently
 
     """
-    datadir = filepath.parent
-    # Retrieving the shape of images for the output
-    img0 = np.load(datadir / IMG_TMP.format(prefix=prefix, idx=0))
+    concatenate_products(n_img, filepath.parent, prefix, {"blends": filepath},
+                         n_jobs=n_jobs)
 
-    # Create placeholder for the images
-    img_indiv = np.empty((n_img, *img0.shape), dtype=img0.dtype)
 
-    # Load and process the images
-    msg = f"Processing the {prefix}ing single images"
-    with click.progressbar(range(n_img), label=msg) as bar:
-        for idx in bar:
-            # Channels last
-            img_indiv[idx, ...] = np.load(datadir / IMG_TMP.format(prefix=prefix, idx=idx))
+def concatenate_single_images(n_img: int, filepath: Path, prefix: str,
+                              n_jobs: int = 1) -> None:
+    """
+    Create a stack of the individual galaxy images, channels last.
+
+    Parameters
+    ----------
+    n_img:
+        number of individual blends
+    filepath:
+        output file, in the directory containing the individual image files
+    prefix: {'train','test'}
+        prefix of the image files corresponding to the split
+    n_jobs: default 1
+        number of threads reading the individual files concurrently
 
-    np.save(filepath, img_indiv.astype(IMG_DTYPE))
+    """
+    concatenate_products(n_img, filepath.parent, prefix,
+                         {"single_images": filepath}, n_jobs=n_jobs)
 
 
 def concatenate_masks(n_img: int, filepath: Path, prefix: str,
-                      method: str) -> None:
+                      method: str, n_jobs: int = 1) -> None:
     """
     Create a stack of masks from the individual files.
 
@@ -95,32 +270,28 @@ def concatenate_masks(n_img: int, filepath: Path, prefix: str,
 
     Parameters
     ----------
-    path:
-        directory containing the individual segmentation files
+    n_img:
+        number of individual blends
+    filepath:
+        output file, in the directory containing the individual segmentation files
     prefix: {'train','test'}
         prefix of the image files corresponding to the split
     method: {'bogg_masks', 'ogg_masks', 'gg_masks}
         name of existing methods in `blender.segmap` to produce the labels
+    n_jobs: default 1
+        number of threads reading the individual files concurrently
 
     """
-    datadir = filepath.parent
-
-    mask_builder: Callable = getattr(segmap, method)
-
-    # Retrieving the shape of images for the output
-    img0 = mask_builder(np.load(datadir / SEG_TMP.format(prefix=prefix, idx=0)))
+    concatenate_products(n_img, filepath.parent, prefix, {method: filepath},
+                         n_jobs=n_jobs)
 
-    # Create placeholder for the images
-    imgmain = np.empty((n_img, *img0.shape), dtype=img0.dtype)
 
-    # Load and process the images
-    msg = f"Processing the {prefix}ing masks"
-    with click.progressbar(range(n_img), label=msg) as bar:
-        for idx in bar:
-            seg = np.load(datadir / SEG_TMP.format(prefix=prefix, idx=idx))
-            imgmain[idx] = mask_builder(seg)
-
-    np.save(filepath, imgmain.astype(SEG_DTYPE))
+def report_errors(errors: Dict[str, Dict[str, float]], precision: str) -> None:
+    """Print the quantisation errors in units of the background noise"""
+    for product, error in errors.items():
+        click.echo(
+            f"{product} stored as {precision}: max error {error['max']:.2e}, "
+            f"RMS error {error['rms']:.2e} of the background noise")
 
 
 @click.command("concatenate")
@@ -140,10 +311,49 @@ def concatenate_masks(n_img: int, filepath: Path, prefix: str,
         "gg_masks",
         "single_images"
     ]),
+    multiple=True,
     required=True,
+    help="Target to produce, can be repeated to build several targets at once",
+)
+@click.option(
+    "-j",
+    "--n_jobs",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Number of threads reading the individual files",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["npy", "shards"]),
+    default="npy",
+    show_default=True,
+    help="One stack per product, or shards of blends with an index",
 )
+@click.option(
+    "--shard_size",
+    type=click.IntRange(min=1),
+    default=4096,
+    show_default=True,
+    help="Number of blends per shard",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(PRECISIONS),
+    default="float32",
+    show_default=True,
+    help="Storage precision of the blends and single images",
+)
+@click.option(
+    "--max_memory",
+    default=None,
+    help="Memory budget, e.g. 4G, above which the stacks are streamed to disk",
+)
+@click.option("--dry_run", is_flag=True, help="Print the memory plan and exit")
 @click.option("--delete", is_flag=True, help="Delete individual images once finished")
-def main(image_dir, method, delete):
+def main(image_dir, method, n_jobs, output_format, shard_size, precision,
+         max_memory, dry_run, delete):
     """
     Concatenate the individual blended sources and masks from <image-dir>
     to create binary files with blends and targets.
@@ -155,29 +365,96 @@ def main(image_dir, method, delete):
     - `bogg_masks` for Background, Overlap, Galaxy, Galaxy masks
     - `single_images` for the individual galaxy stamps.
 
+    Several targets can be requested at once by repeating the --method
+    option, in which case each individual file is read only once.
+
     Details for the various mask methods can be found in `blender/segmap.py`
 
+    With --format shards, each split is written to a `<prefix>_shards`
+    directory of shards of --shard_size blends holding all the products and
+    the catalogue rows, written concurrently and indexed by `index.json`.
+    They are read with `blender.shards.ShardedDataset`.
+
+    With --precision float16 or int16, the blends and single images are
+    stored with reduced precision, the int16 images having one scale and
+    offset per blend in the catalogue (see `blender/precision.py`). The
+    quantisation errors relative to the background noise are reported and
+    saved in `<prefix>_precision.json`.
+
+    With --max_memory, the stacks that do not fit in the given budget are
+    written progressively to memory-mapped files instead of being built in
+    memory, and fewer shards are written at once with --format shards.
+    Use --dry_run to only print the memory plan of each split.
+
     Use the --delete option to remove the individual image files at the end.
 
     """
     datadir = Path.cwd() / image_dir
+    if max_memory is not None:
+        try:
+            budget = parse_size(max_memory)
+        except ValueError as error:
+            raise click.BadParameter(str(error), param_hint="--max_memory")
+    else:
+        budget = physical_memory()
 
     for prefix in ["train", "test"]:
         n_img = len(list(datadir.glob(f"{prefix}_blend_seg_*npy")))
 
-        blend_file = datadir / f"{prefix}_blends.npy"
-        target_file = datadir / f"{prefix}_{method}.npy"
-
-        if not blend_file.exists():
-            concatenate_blends(n_img, blend_file, prefix)
-            click.echo(f"=> {blend_file} created")
-
-        if not target_file.exists():
-            if method == "single_images":
-                concatenate_single_images(n_img, target_file, prefix)
-            else:
-                concatenate_masks(n_img, target_file, prefix, method=method)
-            click.echo(f"=> {target_file} created")
+        shard_dir = datadir / f"{prefix}_shards"
+        if output_format == "shards":
+            if (shard_dir / INDEX_FILE).exists():
+                continue
+            # The shards hold all the products, whichever stacks already exist
+            products = {product: shard_dir for product in ("blends", *method)}
+        else:
+            products = {
+                product: datadir / f"{prefix}_{product}.npy"
+                for product in ("blends", *method)
+            }
+            products = {
+                product: filepath
+                for product, filepath in products.items()
+                if not filepath.exists()
+            }
+
+        settings = {}
+        if products and n_img and (max_memory is not None or dry_run):
+            rows, source_bytes = product_rows(datadir, prefix, products,
+                                              precision)
+            try:
+                if output_format == "shards":
+                    plan = plan_shards(budget, n_img, shard_size, rows,
+                                       source_bytes, n_jobs=n_jobs)
+                else:
+                    plan = plan_concatenate(budget, n_img, rows, source_bytes,
+                                            n_jobs=n_jobs)
+            except MemoryBudgetError as error:
+                raise click.UsageError(str(error))
+            click.echo(f"Memory plan of the {prefix}ing products")
+            click.echo(format_plan(plan))
+            settings = plan.settings
+
+        if dry_run:
+            continue
+
+        if output_format == "shards":
+            write_shards(n_img, datadir, prefix, list(products), shard_size,
+                         n_jobs=settings.get("n_jobs", n_jobs),
+                         precision=precision)
+            click.echo(f"=> {shard_dir} created")
+            with open(shard_dir / INDEX_FILE) as f:
+                report_errors(json.load(f)["errors"], precision)
+        else:
+            errors = concatenate_products(n_img, datadir, prefix, products,
+                                          n_jobs=n_jobs, precision=precision,
+                                          **settings)
+            for filepath in products.values():
+                click.echo(f"=> {filepath} created")
+            if errors:
+                report_errors(errors, precision)
+                with open(datadir / f"{prefix}_precision.json", "w") as f:
+                    json.dump(dict(precision=precision, errors=errors), f, indent=2)
 
         if delete:
             for img in datadir.glob(f"{prefix}_blend_*.npy"):
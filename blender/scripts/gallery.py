@@ -0,0 +1,237 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional, Sequence, Tuple
+
+import click
+import numpy as np  # type: ignore
+
+from blender.dataset import BlendDataset
+from blender.scripts.concatenate_blends import IMG_TMP, SEG_TMP
+from blender import segmap
+
+MASK_METHODS = ["gg_masks", "ogg_masks", "bogg_masks"]
+
+
+def load_blends(datadir: Path, prefix: str, indices: np.ndarray,
+                masks: Optional[str] = None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Read the stored blends of the given indices and their galaxy masks
+
+    The concatenated `<prefix>_blends.npy` and `<prefix>_<masks>.npy` files
+    are used when present, otherwise the individual blend files.
+
+    Returns
+    -------
+    blends:
+        array of shape (B, N, N)
+    outlines:
+        boolean array of shape (B, K, N, N) of the galaxy masks, or None
+
+    """
+    dataset = BlendDataset(datadir, prefix)
+    products = dataset.products
+    outlines = None
+
+    if "blends" in products:
+        blends = dataset.take(indices, products=["blends"])["blends"]
+    else:
+        blends = np.stack([
+            np.load(datadir / IMG_TMP.format(prefix=prefix, idx=idx)).sum(axis=-1)
+            for idx in indices
+        ])
+
+    if masks is None:
+        return blends, outlines
+
+    if masks in products:
+        stored = dataset.take(indices, products=[masks])[masks]
+    else:
+        mask_builder = getattr(segmap, masks)
+        stored = np.stack([
+            mask_builder(np.load(datadir / SEG_TMP.format(prefix=prefix, idx=idx)))
+            for idx in indices
+        ])
+
+    # Back to one (N, N) mask per galaxy
+    if masks == "gg_masks":
+        outlines = stored
+    elif masks == "ogg_masks":
+        outlines = np.moveaxis(stored[..., 1:], -1, 1)
+    else:
+        outlines = np.moveaxis(stored[..., 2:], -1, 1)
+
+    return blends, outlines.astype(bool)
+
+
+def mosaic(tiles: np.ndarray, ncols: int, fill: float = 0) -> np.ndarray:
+    """Arrange (B, N, N) tiles on a grid of `ncols` columns"""
+    n_tiles, size_y, size_x = tiles.shape
+    nrows = -(-n_tiles // ncols)
+    grid = np.full((nrows * ncols, size_y, size_x), fill, dtype=tiles.dtype)
+    grid[:n_tiles] = tiles
+    grid = grid.reshape(nrows, ncols, size_y, size_x)
+    return grid.swapaxes(1, 2).reshape(nrows * size_y, ncols * size_x)
+
+
+def render_sheet(datadir: Path, prefix: str, indices: Sequence[int],
+                 sheet_path: Path, ncols: int = 8,
+                 masks: Optional[str] = None, tile_inches: float = 1.5) -> Path:
+    """
+    Render a contact sheet of stored blends into a PNG file
+
+    Each blend is normalised with `visualisation.asin_stretch_norm` and
+    labelled with its id. With `masks`, the outline of each galaxy mask
+    is drawn on top.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from blender.visualisation import asin_stretch_norm
+
+    indices = np.asarray(indices)
+    blends, outlines = load_blends(datadir, prefix, indices, masks=masks)
+
+    # Tiles are flipped to be displayed from the top left corner while
+    # keeping the origin of each stamp in its lower left corner
+    tiles = np.stack([asin_stretch_norm(blend)(blend).filled(0)
+                      for blend in blends])[:, ::-1]
+    size = tiles.shape[-1]
+    nrows = -(-len(tiles) // ncols)
+
+    fig = plt.figure(figsize=(ncols * tile_inches, nrows * tile_inches))
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.imshow(mosaic(tiles, ncols), origin="upper", cmap="gray",
+              vmin=0, vmax=1, interpolation="nearest")
+
+    if outlines is not None:
+        colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+        for k in range(outlines.shape[1]):
+            ax.contour(mosaic(outlines[:, k, ::-1].astype(np.uint8), ncols),
+                       levels=[0.5], colors=colors[k % len(colors)],
+                       linewidths=0.5)
+
+    for position, idx in enumerate(indices):
+        row, col = divmod(position, ncols)
+        ax.text(col * size + 2, row * size + 2, f"{idx}", color="yellow",
+                fontsize=6, va="top", ha="left")
+
+    ax.set_axis_off()
+    fig.savefig(sheet_path, dpi=size / tile_inches)
+    plt.close(fig)
+
+    return sheet_path
+
+
+@click.command("gallery")
+@click.option(
+    "-d",
+    "--image_dir",
+    metavar="<image-dir>",
+    type=click.Path(exists=True, file_okay=False),
+    required=True,
+)
+@click.option(
+    "-p",
+    "--prefix",
+    type=click.Choice(["train", "test"]),
+    default="train",
+    show_default=True,
+    help="Split of the dataset",
+)
+@click.option(
+    "-q",
+    "--query",
+    default=None,
+    help='Selection on the catalogue columns, e.g. "distance < 10 and g1_mag < 23"',
+)
+@click.option(
+    "-n",
+    "--n_blends",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of blends randomly sampled from the selection (default all)",
+)
+@click.option(
+    "-m",
+    "--masks",
+    type=click.Choice(MASK_METHODS),
+    default=None,
+    help="Draw the outlines of the galaxy masks",
+)
+@click.option(
+    "--grid",
+    type=(int, int),
+    default=(8, 8),
+    show_default=True,
+    help="Number of rows and columns of each contact sheet",
+)
+@click.option(
+    "-j",
+    "--n_jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of rendering processes",
+)
+@click.option(
+    "-o",
+    "--outdir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Output directory of the sheets [default: <image-dir>/gallery]",
+)
+@click.option(
+    "-s",
+    "--seed",
+    type=int,
+    default=42,
+    show_default=True,
+    help="Random seed of the sampling",
+)
+def main(image_dir, prefix, query, n_blends, masks, grid, n_jobs, outdir, seed):
+    """
+    Render contact sheets of the blends stored in <image-dir>.
+
+    The blends are read from the concatenated files if they exist, or from
+    the individual files otherwise, optionally selected with a --query on
+    the catalogue and sampled with --n_blends. The sheets are rendered in
+    parallel as PNG files.
+    """
+    datadir = Path.cwd() / image_dir
+    outdir = datadir / "gallery" if outdir is None else Path.cwd() / outdir
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    dataset = BlendDataset(datadir, prefix)
+    if query is None:
+        indices = np.arange(len(dataset))
+    else:
+        indices = dataset.where(query)
+
+    if n_blends is not None and n_blends < len(indices):
+        rng = np.random.RandomState(seed=seed)
+        indices = np.sort(rng.choice(indices, size=n_blends, replace=False))
+
+    nrows, ncols = grid
+    per_sheet = nrows * ncols
+    sheets = [indices[start:start + per_sheet]
+              for start in range(0, len(indices), per_sheet)]
+    click.echo(f"Rendering {len(indices)} blends on {len(sheets)} sheets")
+
+    msg = f"Rendering the {prefix}ing gallery"
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool, \
+            click.progressbar(length=len(sheets), label=msg) as bar:
+        futures = [
+            pool.submit(render_sheet, datadir, prefix, sheet,
+                        outdir / f"{prefix}_gallery_{number:04d}.png",
+                        ncols=ncols, masks=masks)
+            for number, sheet in enumerate(sheets)
+        ]
+        for future in as_completed(futures):
+            future.result()
+            bar.update(1)
+
+    click.echo(f"=> sheets stored in {outdir}")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
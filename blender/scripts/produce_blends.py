@@ -1,22 +1,104 @@
 import csv
+import json
 import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
 
 import click
 import numpy as np
 
-from blender import Blender, Blend
-from blender.catalog import blend2cat, CATALOG_HEADER
+from blender import Blender, Blend, MultiBlend
+from blender.blender import BlendGroupError
+from blender.catalog import batch_overlap_statistics, blend2cat, multiblend2cat
+from blender.catalog import catalog_header
+from blender.library import apply_cuts, galaxy_masks, load_inputs
+from blender.library import prepare_library, select_galaxies
+from blender.memory import MemoryBudgetError, format_plan, parse_size
+from blender.memory import physical_memory, plan_produce
+from blender.quotas import (PairIndex, QuotaError, check_quotas, index_pairs,
+                            load_quotas, sample_quotas)
+from blender.uniqueness import KEY_SETS, count_unique_blends, key_set
 
+# Library directory used when the inputs do not fit in the memory budget
+DEFAULT_CACHEDIR = "candels-cache"
+# Successive failed draws of a blend of two galaxies before giving up
+MAX_REDRAWS = 10000
 
-def save_img(blend: Blend, idx: int, prefix: str, outdir: Union[Path, str] = ".") -> None:
+
+def save_img(blend: Union[Blend, MultiBlend], idx: int, prefix: str, outdir: Union[Path, str] = ".") -> None:
     np.save(f"{outdir}/{prefix}_blend_{idx:06d}.npy", blend.img)
     np.save(f"{outdir}/{prefix}_blend_seg_{idx:06d}.npy", blend.segmap)
 
 
+class BlendWriter:
+    """
+    Save blend stamps to disk from a pool of background threads.
+
+    Blends are handed over with `submit` and written while the next ones
+    are being computed. At most `max_pending` blends are kept in memory:
+    `submit` blocks until a slot is freed by a finished write.
+    With `n_workers=0` the stamps are written synchronously.
+
+    Parameters
+    ----------
+    outdir:
+        output directory
+    prefix: {'train','test'}
+        prefix of the image files corresponding to the split
+    n_workers:
+        number of writing threads
+    max_pending:
+        maximum number of blends waiting to be written
+
+    """
+    def __init__(self, outdir: Union[Path, str], prefix: str,
+                 n_workers: int = 4, max_pending: int = 32) -> None:
+        self.outdir = outdir
+        self.prefix = prefix
+        self.n_workers = n_workers
+        self._pool = ThreadPoolExecutor(max_workers=n_workers) if n_workers > 0 else None
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._pending: Deque[Future] = deque()
+
+    def submit(self, blend: Union[Blend, MultiBlend], idx: int) -> None:
+        if self._pool is None:
+            save_img(blend, idx, self.prefix, self.outdir)
+            return
+
+        self._slots.acquire()
+        future = self._pool.submit(save_img, blend, idx, self.prefix, self.outdir)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+        self._collect()
+
+    def _collect(self) -> None:
+        """Forget about finished writes, raising the first error met"""
+        while self._pending and self._pending[0].done():
+            self._pending.popleft().result()
+
+    def close(self) -> None:
+        if self._pool is None:
+            return
+        self._pool.shutdown(wait=True)
+        while self._pending:
+            self._pending.popleft().result()
+
+    def __enter__(self) -> "BlendWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
 def create_image_set(blender: Blender, n_blends: int, outdir: Path,
-                     test_set: bool = False) -> None:
+                     test_set: bool = False, n_writers: int = 4,
+                     n_gal: int = 2, batch_size: int = 64,
+                     max_pending: Optional[int] = None,
+                     quotas: Optional[Union[List, PairIndex]] = None,
+                     unique=None) -> None:
     """
     Use a Blender instance to output stamps of blended galaxies and
     their associated segmentation mask, plus a catalog of these sources.
@@ -31,24 +113,84 @@ def create_image_set(blender: Blender, n_blends: int, outdir: Path,
         output directory
     test_set: default False
         switch between the training and testing galaxy split
+    n_writers: default 4
+        number of background threads saving the stamps to disk,
+        0 to write synchronously
+    n_gal: default 2
+        number of galaxies per blend
+    batch_size: default 64
+        number of blends whose overlap statistics are computed at once, and
+        composed at once when n_gal > 2
+    max_pending: optional
+        number of blends waiting to be written, 8 per writer by default
+    quotas: optional
+        target histograms of the blend properties, or the pair index of
+        the split built from them, see `blender.quotas`, only for blends
+        of two galaxies
+    unique: optional
+        key set of the blends already produced, see `blender.uniqueness`,
+        to produce each blend at most once
 
     """
     prefix = "test" if test_set else "train"
 
     outcat = outdir / f"{prefix}_catalogue.csv"
 
-    with open(outcat, "w") as f:
+    if quotas is not None:
+        # Pairs and shifts are drawn beforehand, so every blend is kept
+        pairs, shifts = sample_quotas(blender, quotas, n_blends,
+                                      from_test=test_set, unique=unique)
+
+    if max_pending is None:
+        max_pending = 8 * n_writers
+    writer = BlendWriter(outdir, prefix, n_workers=n_writers,
+                         max_pending=max_pending)
+
+    # The catalogue is written from the main thread to keep the row order
+    with open(outcat, "w") as f, writer:
         output = csv.writer(f)
-        output.writerow(CATALOG_HEADER)
+        output.writerow(catalog_header(n_gal))
+
+        to_cat = blend2cat if n_gal == 2 else multiblend2cat
+
+        def write_batch(blends: List, start: int) -> None:
+            # The overlap statistics are computed once for the whole batch
+            stats = batch_overlap_statistics(blends)
+            for blend_id, blend in enumerate(blends, start=start):
+                output.writerow(to_cat(blend, blend_id, stats[blend_id - start]))
+                writer.submit(blend, blend_id)
 
         msg = f"Producing {prefix} blended images"
-        with click.progressbar(range(n_blends), label=msg) as bar:
-            for blend_id in bar:
-                blend = blender.next_blend(from_test=test_set)
-                while blend is None:
-                    blend = blender.next_blend(from_test=test_set)
-                output.writerow(blend2cat(blend, blend_id))
-                save_img(blend, blend_id, prefix, outdir)
+        with click.progressbar(length=n_blends, label=msg) as bar:
+            for start in range(0, n_blends, batch_size):
+                size = min(batch_size, n_blends - start)
+                if quotas is not None:
+                    blends = []
+                    for blend_id in range(start, start + size):
+                        gal1, gal2 = (blender.galaxy(idx) for idx in pairs[blend_id])
+                        blends.append(blender.blend(gal1, gal2,
+                                                    coords=shifts[blend_id].tolist()))
+                elif n_gal == 2:
+                    blends = []
+                    failures = 0
+                    while len(blends) < size:
+                        if failures >= MAX_REDRAWS:
+                            raise BlendGroupError(
+                                f"Could not draw a new {prefix} blend after "
+                                f"{MAX_REDRAWS} tries, most of the blends "
+                                "allowed by the cuts may have been produced "
+                                "already")
+                        blend = blender.next_blend(from_test=test_set, unique=unique)
+                        if blend is None:
+                            failures += 1
+                        else:
+                            blends.append(blend)
+                            failures = 0
+                else:
+                    blends = blender.next_blends(size, n_gal, from_test=test_set,
+                                                 unique=unique)
+                write_batch(blends, start)
+                bar.update(size)
 
 
 @click.command("produce")
@@ -119,22 +261,290 @@ def create_image_set(blender: Blender, n_blends: int, outdir: Path,
     show_default=True,
     help="Random seed",
 )
+@click.option(
+    "-w",
+    "--n_writers",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Number of background threads writing the stamps (0 for synchronous)",
+)
+@click.option(
+    "--cachedir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of the prepared input libraries, created if needed",
+)
+@click.option(
+    "--noise",
+    type=click.Choice(["strict", "bank"]),
+    default="strict",
+    show_default=True,
+    help="Background noise from fresh draws or from a pre-generated bank",
+)
+@click.option(
+    "-k",
+    "--n_gal",
+    type=click.IntRange(min=2),
+    default=2,
+    show_default=True,
+    help="Number of galaxies per blend",
+)
+@click.option(
+    "--batch_size",
+    type=click.IntRange(min=1),
+    default=64,
+    show_default=True,
+    help="Number of blends processed at once, and composed at once for more than 2 galaxies",
+)
+@click.option(
+    "--augment",
+    type=click.Choice(["none", "dihedral", "subpixel"]),
+    default="none",
+    show_default=True,
+    help="Random rotations and flips of the stamps, plus sub-pixel shifts",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["reference", "fused"]),
+    default="reference",
+    show_default=True,
+    help="Implementation of the blending, fused uses numba if installed",
+)
+@click.option(
+    "--sweep",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="JSON file listing several configurations to produce in one go",
+)
+@click.option(
+    "--quotas",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="JSON file of target histograms of the blend properties",
+)
+@click.option(
+    "--unique",
+    type=click.Choice(["none", *KEY_SETS]),
+    default="none",
+    show_default=True,
+    help="Produce each blend at most once, tracked by an exact set or a Bloom filter",
+)
+@click.option(
+    "--max_memory",
+    default=None,
+    help="Memory budget, e.g. 4G, used to size the batches and the inputs",
+)
+@click.option("--dry_run", is_flag=True, help="Print the memory plan and exit")
 def main(n_blends, excluded_type, mag_low, mag_high, mag_diff, rad_diff,
-         test_ratio, datapath, seed):
+         test_ratio, datapath, seed, n_writers, cachedir, noise, n_gal,
+         batch_size, augment, backend, sweep, quotas, unique, max_memory,
+         dry_run):
     """
     Produce stamps of CANDELS blended galaxies with their individual masks
+
+    \b
+    With --sweep, the given JSON file contains a list of configurations,
+    e.g. [{"mag_diff": 1, "seed": 1}, {"mag_diff": 2, "outdir": "magdiff2"}]
+    where the keys are the long names of the options above, plus an
+    optional `outdir`. Missing keys take the values of the command line.
+    The inputs are loaded and masked once and shared by all configurations,
+    or read from the prepared libraries of --cachedir when given.
+
+    With --quotas, the pairs of galaxies and their shifts are drawn to follow
+    target histograms of the distance, magnitude difference, combination of
+    galaxy types and redshift, e.g. {"distance": {"bins": [0, 10, 20, 40]}}
+    for a flat distribution of distances (see `blender/quotas.py`).
+
+    A galaxy is never blended with itself, and with --unique the same
+    galaxies and shifts are never drawn twice. The number of distinct blends
+    of two galaxies allowed by the cuts is reported beforehand. The `bloom`
+    set takes a few bytes per blend, at the cost of rejecting about one new
+    blend in a million.
+
+    With --max_memory, the batch size and the number of blends waiting to
+    be written are chosen to stay within the given budget, and the inputs
+    are read from a memory-mapped library (in --cachedir, by default
+    `candels-cache`) if they do not fit in memory. Use --dry_run to only
+    print the memory plan.
     """
     # Define the various paths and create directories
     cwd = Path.cwd()
     datapath = cwd / datapath
-    input_stamps = datapath / "candels_img.npy"
-    input_segmaps = datapath / "candels_seg.npy"
-    input_catalog = datapath / "candels_cat.csv"
+    inputs = (
+        datapath / "candels_img.npy",
+        datapath / "candels_seg.npy",
+        datapath / "candels_cat.csv",
+    )
 
-    outdir = cwd / f"output-s_{seed}-n_{n_blends}"
-    if not outdir.exists():
-        outdir.mkdir()
-    outlog = outdir / "candels-blender.log"
+    config = dict(
+        n_blends=n_blends,
+        excluded_type=list(excluded_type),
+        mag_low=mag_low,
+        mag_high=mag_high,
+        mag_diff=mag_diff,
+        rad_diff=rad_diff,
+        test_ratio=test_ratio,
+        seed=seed,
+        noise=noise,
+        n_gal=n_gal,
+        batch_size=batch_size,
+        augment=augment,
+        backend=backend,
+        quotas=quotas,
+        unique=unique,
+        outdir=f"output-s_{seed}-n_{n_blends}",
+    )
+
+    configs = [config]
+    if sweep is not None:
+        configs = load_sweep(cwd / sweep, config, click.get_current_context())
+    for config in configs:
+        check_config(config, cwd)
+    plans = [None] * len(configs)
+    # A sweep shares the inputs in memory, unless libraries are requested
+    share = sweep is not None and cachedir is None
+
+    if max_memory is not None or dry_run:
+        if max_memory is not None:
+            try:
+                budget = parse_size(max_memory)
+            except ValueError as error:
+                raise click.BadParameter(str(error), param_hint="--max_memory")
+        else:
+            budget = physical_memory()
+
+        try:
+            plans = [
+                plan_produce(budget, inputs[0], inputs[1], n_gal=config["n_gal"],
+                             batch_size=config["batch_size"], n_writers=n_writers,
+                             noise=config["noise"],
+                             use_library=not share and cachedir is not None,
+                             share_masks=share)
+                for config in configs
+            ]
+        except MemoryBudgetError as error:
+            raise click.UsageError(str(error))
+
+        for config, plan in zip(configs, plans):
+            click.echo(f"Memory plan of {config['outdir']}")
+            click.echo(format_plan(plan))
+        if dry_run:
+            return
+
+        if any(plan.settings["use_library"] for plan in plans):
+            share = False
+            if cachedir is None:
+                cachedir = DEFAULT_CACHEDIR
+        for config, plan in zip(configs, plans):
+            config["batch_size"] = plan.settings.get("batch_size", config["batch_size"])
+
+    shared = None
+    if share:
+        click.echo(
+            f"Loading and masking the input galaxies once for {len(configs)} "
+            "configurations"
+        )
+        shared = load_inputs(*inputs)
+        shared.update(galaxy_masks(shared["stamps"], shared["segmaps"]))
+    elif sweep is not None:
+        click.echo(
+            f"Reading the input galaxies of {len(configs)} configurations "
+            f"from the prepared libraries in {cachedir}"
+        )
+
+    for config, plan in zip(configs, plans):
+        settings = {} if plan is None else plan.settings
+        produce_dataset(config, inputs, cwd, n_writers=n_writers,
+                        cachedir=cachedir, shared=shared,
+                        max_pending=settings.get("max_pending"),
+                        library_chunk_size=settings.get("library_chunk_size", 256))
+
+
+def load_sweep(sweepfile: Path, defaults: Dict[str, Any],
+               ctx: click.Context) -> List[Dict[str, Any]]:
+    """
+    Read a list of configurations from a JSON file
+
+    Missing keys take the values of `defaults`, except for the output
+    directory which defaults to `sweep_<index>-s_<seed>-n_<n_blends>`.
+    The values are converted and validated with the types of the options
+    of the command of `ctx`, as on the command line.
+    """
+    options = {param.name: param for param in ctx.command.params}
+    with open(sweepfile) as f:
+        entries = json.load(f)
+
+    if not isinstance(entries, list):
+        raise click.BadParameter("must contain a list of configurations",
+                                 param_hint="--sweep")
+
+    configs = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise click.BadParameter(f"configuration {index} is not an object",
+                                     param_hint="--sweep")
+        unknown = set(entry) - set(defaults)
+        if unknown:
+            raise click.BadParameter(
+                f"unknown keys {sorted(unknown)} in configuration {index}",
+                param_hint="--sweep")
+        values = {}
+        for key, value in entry.items():
+            if key == "outdir":
+                if not isinstance(value, str) or not value:
+                    raise click.BadParameter(
+                        f"outdir must be a non-empty string in configuration {index}",
+                        param_hint="--sweep")
+                values[key] = value
+                continue
+            option = options[key]
+            if option.multiple and isinstance(value, str):
+                value = [value]
+            try:
+                value = option.type_cast_value(ctx, value)
+            except click.BadParameter as error:
+                raise click.BadParameter(
+                    f"invalid {key} in configuration {index}: {error.message}",
+                    param_hint="--sweep")
+            values[key] = list(value) if option.multiple else value
+        config = {**defaults, **values}
+        if "outdir" not in entry:
+            config["outdir"] = (
+                f"sweep_{index:03d}-s_{config['seed']}-n_{config['n_blends']}")
+        configs.append(config)
+
+    outdirs = [config["outdir"] for config in configs]
+    if len(set(outdirs)) != len(outdirs):
+        raise click.BadParameter("the configurations must have distinct outdir",
+                                 param_hint="--sweep")
+
+    return configs
+
+
+def check_config(config: Dict[str, Any], cwd: Path) -> None:
+    """
+    Check the options of a configuration that depend on each other, so
+    that all the configurations of a sweep are valid before producing any
+    """
+    if config["quotas"] is None:
+        return
+    if config["n_gal"] != 2:
+        raise click.UsageError(
+            f"--quotas only applies to blends of two galaxies ({config['outdir']})")
+    try:
+        load_quotas(cwd / config["quotas"])
+    except (QuotaError, KeyError, ValueError) as error:
+        raise click.BadParameter(f"{error} ({config['outdir']})",
+                                 param_hint="--quotas")
+
+
+def setup_logging(outlog: Path) -> None:
+    """Send the log to the given file, replacing any previous handler"""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
 
     logging.basicConfig(
         filename=outlog,
@@ -142,45 +552,112 @@ def main(n_blends, excluded_type, mag_low, mag_high, mag_diff, rad_diff,
         format="%(asctime)s [ %(levelname)s ] : %(message)s",
     )
 
-    blender = Blender(
-        input_stamps,
-        input_segmaps,
-        input_catalog,
-        train_test_ratio=test_ratio,
-        magdiff=mag_diff,
-        raddiff=rad_diff,
-        seed=seed,
+
+def produce_dataset(config: Dict[str, Any], inputs: Tuple[Path, Path, Path],
+                    cwd: Path, n_writers: int = 4,
+                    cachedir: Optional[str] = None,
+                    shared: Optional[Dict[str, Any]] = None,
+                    max_pending: Optional[int] = None,
+                    library_chunk_size: int = 256) -> None:
+    """
+    Produce the train and test sets of one configuration
+
+    Parameters
+    ----------
+    config:
+        values of the produce options, plus the output directory `outdir`
+    inputs:
+        paths to the input stamps, segmaps and catalogue
+    cwd:
+        directory in which the outputs are created
+    n_writers:
+        number of background threads saving the stamps to disk
+    cachedir: optional
+        directory of the prepared input libraries
+    shared: optional
+        input arrays and galaxy masks already loaded, see
+        `blender.library.load_inputs` and `blender.library.galaxy_masks`
+    max_pending: optional
+        number of blends waiting to be written, see `create_image_set`
+    library_chunk_size: default 256
+        number of galaxies read at once to build the library, see
+        `blender.library.prepare_library`
+
+    """
+    quotas = None
+    if config["quotas"] is not None:
+        # Already validated by `check_config`
+        quotas = load_quotas(cwd / config["quotas"])
+
+    outdir = cwd / config["outdir"]
+    if not outdir.exists():
+        outdir.mkdir()
+    setup_logging(outdir / "candels-blender.log")
+
+    cuts = dict(
+        mag_low=config["mag_low"],
+        mag_high=config["mag_high"],
+        excluded_type=config["excluded_type"],
     )
+    blender_params = dict(
+        train_test_ratio=config["test_ratio"],
+        magdiff=config["mag_diff"],
+        raddiff=config["rad_diff"],
+        seed=config["seed"],
+        noise=config["noise"],
+        augment=config["augment"],
+        backend=config["backend"],
+    )
+    if shared is not None:
+        arrays, n_gal_history = apply_cuts(shared, **cuts)
+        blender = Blender.from_arrays(arrays, n_gal_history, **blender_params)
+    elif cachedir is not None:
+        libdir = prepare_library(*inputs, cwd / cachedir, **cuts,
+                                 chunk_size=library_chunk_size)
+        click.echo(f"Using the prepared input library {libdir}")
+        blender = Blender.from_library(libdir, **blender_params)
+    else:
+        blender = Blender(*inputs, **blender_params)
+
+    with open(outdir / "config.json", "w") as f:
+        json.dump(config, f, indent=2)
 
     logger = logging.getLogger(__name__)
     logger.info(
         "\n"
         "Configuration\n"
         "=============\n"
-        f"Number of blends: {n_blends}\n"
-        f"Seed: {seed}\n"
+        f"Number of blends: {config['n_blends']}\n"
+        f"Number of galaxies per blend: {config['n_gal']}\n"
+        f"Seed: {config['seed']}\n"
+        f"Background noise: {config['noise']}\n"
+        f"Stamp augmentation: {config['augment']}\n"
+        f"Blending backend: {config['backend']}\n"
+        f"Quotas: {config['quotas']}\n"
+        f"Unique blends: {config['unique']}\n"
         "\n"
         "Catalog cuts\n"
         "------------\n"
-        f"Excluded galaxy types: {excluded_type}\n"
-        f"Lowest magnitude: {mag_low}\n"
-        f"Highest magnitude: {mag_high}\n"
+        f"Excluded galaxy types: {tuple(config['excluded_type'])}\n"
+        f"Lowest magnitude: {config['mag_low']}\n"
+        f"Highest magnitude: {config['mag_high']}\n"
         "\n"
         "Blend properties\n"
         "----------------\n"
-        f"Top difference in magnitude between galaxies: {mag_diff}\n"
-        f"Top distance between galaxies as a fraction of radius: {rad_diff}\n"
+        f"Top difference in magnitude between galaxies: {config['mag_diff']}\n"
+        f"Top distance between galaxies as a fraction of radius: {config['rad_diff']}\n"
     )
 
     # Apply cuts to the galaxy catalog
     click.echo(
-        f"Selecting galaxies in the magnitude range {mag_low} < m < {mag_high}"
+        f"Selecting galaxies in the magnitude range "
+        f"{config['mag_low']} < m < {config['mag_high']}"
     )
-    blender.make_cut(blender.cat.mag > mag_low)
-    blender.make_cut(blender.cat.mag < mag_high)
-    for galtype in set(excluded_type):
+    for galtype in sorted(set(config["excluded_type"])):
         click.echo(f"Excluding {galtype} galaxies")
-        blender.make_cut(blender.cat.galtype != galtype)
+    if shared is None and cachedir is None:
+        for selection in select_galaxies(blender.cat, **cuts):
+            blender.make_cut(selection)
 
     click.echo(
         f"After the cuts, there are {blender.n_gal} individual galaxies "
@@ -188,11 +665,56 @@ def main(n_blends, excluded_type, mag_low, mag_high, mag_diff, rad_diff,
     )
 
     # Compute the train/test splits
-    n_test = int(test_ratio * n_blends)
-    n_train = n_blends - n_test
+    n_test = int(config["test_ratio"] * config["n_blends"])
+    n_train = config["n_blends"] - n_test
+
+    split_quotas = {False: quotas, True: quotas}
+    if quotas is not None:
+        # The pairs of each split are enumerated and binned only once
+        split_quotas = {from_test: index_pairs(blender, quotas, from_test)
+                        for from_test in (False, True)}
+        try:
+            check_quotas(blender, split_quotas[False], n_train)
+            check_quotas(blender, split_quotas[True], n_test, from_test=True)
+        except QuotaError as error:
+            raise click.BadParameter(str(error), param_hint="--quotas")
+
+    if config["n_gal"] == 2 and quotas is None:
+        # The quota sampler checks the number of blends of each cell instead
+        for split, n_split, from_test in (("train", n_train, False),
+                                          ("test", n_test, True)):
+            if n_split == 0:
+                continue
+            n_unique = count_unique_blends(blender, from_test=from_test)
+            click.echo(f"At most {n_unique} unique {split} blends can be "
+                       f"drawn under the cuts, {n_split} requested")
+            logger.info(f"Achievable unique {split} blends: {n_unique}")
+            if n_unique == 0:
+                raise click.UsageError(
+                    f"No {split} blend can be drawn under the cuts, "
+                    "try a larger --mag_diff or --rad_diff")
+            if config["unique"] != "none" and n_split > n_unique:
+                raise click.UsageError(
+                    f"Cannot produce {n_split} unique {split} blends, "
+                    f"at most {n_unique} are possible")
+
+    unique = None
+    if config["unique"] != "none":
+        unique = key_set(config["unique"], capacity=config["n_blends"])
+
+    image_set_params = dict(n_writers=n_writers, n_gal=config["n_gal"],
+                            batch_size=config["batch_size"],
+                            max_pending=max_pending, unique=unique)
 
-    create_image_set(blender, n_train, outdir)
-    create_image_set(blender, n_test, outdir, test_set=True)
+    try:
+        create_image_set(blender, n_train, outdir, quotas=split_quotas[False],
+                         **image_set_params)
+        create_image_set(blender, n_test, outdir, test_set=True,
+                         quotas=split_quotas[True], **image_set_params)
+    except QuotaError as error:
+        raise click.BadParameter(str(error), param_hint="--quotas")
+    except BlendGroupError as error:
+        raise click.UsageError(str(error))
 
     click.echo(message=f"Images stored in {outdir}")
 
@@ -1,7 +1,12 @@
+from typing import Dict, Optional, Tuple
+
 import numpy as np  # type: ignore
-from scipy.ndimage import binary_dilation  # type: ignore
 
 from blender.core import Stamp
+from blender.noise import NoiseBank
+
+# Fresh draws from `np.random`, used when no noise source is given
+DEFAULT_NOISE = NoiseBank(strict=True)
 
 
 def normalize_segmap(segmap: Stamp) -> Stamp:
@@ -15,18 +20,18 @@ def normalize_segmap(segmap: Stamp) -> Stamp:
     return new_segmap
 
 
-def mask_out_pixels(img: Stamp, segmap: Stamp, segval: Stamp,
-                    n_iter: int = 5, shuffle: bool = False,
-                    noise_factor: int = 1) -> Stamp:
+def neighbour_masks(segmap: Stamp, segval: Stamp,
+                    n_iter: int = 5) -> Tuple[Stamp, Stamp]:
     """
-    Replace central galaxy neighbours with background noise
+    Return the background mask and the mask of the central galaxy neighbours
 
-    Basic recipe to replace the detected sources around the central galaxy
-    with either randomly selected pixels from the background, or a random
-    realisation of the background noise.
+    Both masks are dilated by `n_iter` pixels with respect to the
+    segmentation map. They only depend on the segmentation map and can
+    therefore be computed once per galaxy.
 
     """
-    masked_img = img.copy()
+    from scipy.ndimage import binary_dilation  # type: ignore
+
     # Create binary masks of all segmented sources
     sources = binary_dilation(segmap, iterations=n_iter)
     background_mask = np.logical_not(sources)
@@ -36,7 +41,53 @@ def mask_out_pixels(img: Stamp, segmap: Stamp, segval: Stamp,
     # Compute the binary mask of all sources BUT the central galaxy
     sources_except_central = np.logical_xor(sources, central_source)
 
+    return background_mask, sources_except_central
+
+
+def background_noise_std(img: Stamp, background_mask: Stamp) -> float:
+    """Standard deviation of the stamp once the sources are zeroed"""
+    return np.std(img * background_mask)
+
+
+def fill_in_noise(img: Stamp, neighbours: Stamp, background_std: float,
+                  noise_factor: int = 1,
+                  noise: Optional[NoiseBank] = None) -> Stamp:
+    """
+    Replace the `neighbours` pixels with a realisation of the background
+    noise and add some extra noise to the whole stamp.
+
+    The noise is drawn from `noise` if provided, otherwise with fresh
+    calls to `np.random.normal`.
+    """
+    if noise is None:
+        noise = DEFAULT_NOISE
+
+    masked_img = img.copy()
+    # Create a realisation of the background for the std value
+    random_background = noise.draw(img.shape, background_std)
+    masked_img[neighbours] = random_background[neighbours]
+    masked_img += noise_factor * noise.draw(img.shape, background_std)
+
+    return masked_img.astype(img.dtype)
+
+
+def mask_out_pixels(img: Stamp, segmap: Stamp, segval: Stamp,
+                    n_iter: int = 5, shuffle: bool = False,
+                    noise_factor: int = 1,
+                    noise: Optional[NoiseBank] = None) -> Stamp:
+    """
+    Replace central galaxy neighbours with background noise
+
+    Basic recipe to replace the detected sources around the central galaxy
+    with either randomly selected pixels from the background, or a random
+    realisation of the background noise, drawn from `noise` if provided.
+
+    """
+    background_mask, sources_except_central = neighbour_masks(segmap, segval,
+                                                              n_iter=n_iter)
+
     if shuffle:
+        masked_img = img.copy()
         # Select random pixels from the noise in the image
         n_pixels_to_fill_in = sources_except_central.sum()
         random_background_pixels = np.random.choice(
@@ -45,14 +96,57 @@ def mask_out_pixels(img: Stamp, segmap: Stamp, segval: Stamp,
         )
         # Fill in the voids with these pixels
         masked_img[sources_except_central] = random_background_pixels
-    else:
-        # Create a realisation of the background for the std value
-        background_std = np.std(img * background_mask)
-        random_background = np.random.normal(scale=background_std, size=img.shape)
-        masked_img[sources_except_central] = random_background[sources_except_central]
-        masked_img += noise_factor * np.random.normal(scale=background_std, size=img.shape)
+        return masked_img.astype(img.dtype)
 
-    return masked_img.astype(img.dtype)
+    background_std = background_noise_std(img, background_mask)
+    return fill_in_noise(img, sources_except_central, background_std,
+                         noise_factor=noise_factor, noise=noise)
+
+
+def overlap_statistics(img: Stamp, segmap: Stamp) -> Dict[str, Stamp]:
+    """
+    Compute the overlap properties of blends of K galaxies.
+
+    Works on a single blend or on a batch of blends stacked on the first
+    axis, with the conventions of `blender.core.Blend`: `img` of shape
+    ([B,] N, N, K) and `segmap` of shape ([B,] K, N, N).
+
+    Returns a dictionary of arrays of shape ([B,]) with
+      - `overlap_area`: number of pixels covered by at least two segmaps
+      - `g{i}_blendedness`: 1 - sum(I_i * I_i) / sum(I_i * I_blend),
+        with the sums over the segmap of galaxy i
+      - `g{i}_overlap_frac`: fraction of the flux of galaxy i, within
+        its segmap, falling in the overlap region
+
+    """
+    img = np.moveaxis(np.asarray(img, dtype=np.float64), -1, -3)
+    segmap = np.asarray(segmap).astype(bool)
+    blend = img.sum(axis=-3, keepdims=True)
+    overlap = overlap_mask(segmap)
+
+    def pixsum(array):
+        return array.sum(axis=(-2, -1))
+
+    gal_flux = pixsum(img * segmap)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        blendedness = 1 - pixsum(img * img * segmap) / pixsum(img * blend * segmap)
+        overlap_frac = pixsum(img * overlap[..., None, :, :]) / gal_flux
+
+    n_gal = segmap.shape[-3]
+    stats = {"overlap_area": pixsum(overlap)}
+    stats.update({f"g{i + 1}_blendedness": blendedness[..., i]
+                  for i in range(n_gal)})
+    stats.update({f"g{i + 1}_overlap_frac": overlap_frac[..., i]
+                  for i in range(n_gal)})
+
+    return stats
+
+
+def overlap_mask(segmap: Stamp) -> Stamp:
+    """
+    Mask of the pixels covered by at least two of the ([B,] K, N, N) segmaps
+    """
+    return np.count_nonzero(segmap, axis=-3) >= 2
 
 
 def gg_masks(segmap: Stamp, dtype=np.uint8) -> np.array:
@@ -68,22 +162,19 @@ def ogg_masks(segmap: Stamp, dtype=np.uint8) -> Stamp:
 
     OGG stands for Overlap, Galaxy, Galaxy
 
-    The input segmap is of shape (N, N, 2) where NxN is the dimensension
-    of the stamps and the third axes corresponds to the two galaxies,
-    ordered as central first and companion second.
+    The input segmap is of shape (K, N, N) where NxN is the dimensension
+    of the stamps and the first axis corresponds to the K galaxies,
+    ordered as central first and companions next.
 
-    The output segmap is of shape (N, N, 3). The third axis is ordered as
-      1) mask of overlapping region
+    The output segmap is of shape (N, N, K + 1). The third axis is ordered as
+      1) mask of overlapping region, covered by at least two galaxies
       2) mask of central galaxy
-      3) mask of companion galaxy
+      3...) masks of companion galaxies
 
     """
     segmap = segmap.astype(bool)
-    s1, s2 = segmap
-    array_list = [
-        np.logical_and(s1, s2),  # overlap
-        s1,                      # galaxy 1
-        s2]                      # galaxy 2
+    array_list = [overlap_mask(segmap),  # overlap
+                  *segmap]               # galaxies
 
     output = np.concatenate(
         [np.expand_dims(arr, axis=-1)
@@ -98,25 +189,24 @@ def bogg_masks(segmap: Stamp, dtype=np.uint8) -> Stamp:
 
     BOGG stands for Background, Overlap, Galaxy, Galaxy
 
-    The input segmap is of shape (N, N, 2) where NxN is the dimensension
-    of the stamps and the third axes corresponds to the two galaxies,
-    ordered as central first and companion second.
+    The input segmap is of shape (K, N, N) where NxN is the dimensension
+    of the stamps and the first axis corresponds to the K galaxies,
+    ordered as central first and companions next.
 
-    The output segmap is of shape (N, N, 4). The third axis is ordered as
+    The output segmap is of shape (N, N, K + 2). The third axis is ordered as
       1) background mask
-      2) mask of overlapping region
+      2) mask of overlapping region, covered by at least two galaxies
       3) mask of central galaxy - 2)
-      4) mask of companion galaxy - 2)
+      4...) masks of companion galaxies - 2)
 
     This way only each pixel of the NxN blend is assigned one category only.
 
     """
     segmap = segmap.astype(bool)
-    s1, s2 = segmap
-    array_list = [~s1 & ~s2,     # background
-                  s1 & s2,       # overlap
-                  s1 ^ s1 & s2,  # s1 without overlap
-                  s2 ^ s1 & s2]  # s2 without overlap
+    overlap = overlap_mask(segmap)
+    array_list = [~segmap.any(axis=0),                 # background
+                  overlap,                             # overlap
+                  *(seg & ~overlap for seg in segmap)]  # galaxies without overlap
 
     output = np.concatenate([np.expand_dims(arr, axis=-1)
                              for arr in array_list], axis=-1)
@@ -0,0 +1,421 @@
+"""
+Sharded output format of the produced datasets.
+
+Instead of one stack per product and split, the blends are grouped into
+fixed-size shards that are written concurrently and can be read
+independently by the workers of a data loader. A sharded split is a
+directory `<prefix>_shards/` containing
+
+  - `shard_<number>/`: one directory per shard holding one `.npy` file
+    per product (`blends.npy`, `ogg_masks.npy`, ...) and one
+    `cat_<column>.npy` file per catalogue column
+  - `index.json`: the description of the products and, for each shard,
+    the range of blend ids it holds and the SHA-256 checksums of its files
+
+Example
+-------
+>>> dataset = ShardedDataset("output-s_42-n_20000", prefix="train")
+>>> blends = dataset.array("blends")
+>>> batch = blends[1000:1064]
+>>> idx = dataset.where("distance < 10")
+>>> subset = dataset.take(idx, products=["blends", "ogg_masks"])
+"""
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+import click
+import numpy as np  # type: ignore
+
+from blender.dataset import evaluate_condition, read_rows
+from blender.precision import IMAGE_PRODUCTS, background_std, dequantise
+from blender.precision import noise_relative_errors, quantise
+
+PathType = Union[Path, str]
+
+SHARDS_VERSION = 1
+INDEX_FILE = "index.json"
+SHARD_TMP = "shard_{number:05d}"
+
+
+def file_checksum(filepath: Path, block_size: int = 2**20) -> str:
+    """SHA-256 hexdigest of a file, read by blocks"""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_shard(datadir: Path, prefix: str, products: Sequence[str],
+                columns: Dict[str, np.ndarray], start: int, stop: int,
+                shard_dir: Path, precision: str = "float32") -> Dict[str, Any]:
+    """
+    Write the blends [start, stop) of a split into a shard directory
+
+    The image products are stored with the given precision, the int16
+    scales and offsets being added to the catalogue columns of the shard.
+
+    Returns
+    -------
+    entry of the shard in the index
+
+    """
+    # Imported here to avoid a circular import with the concatenate script
+    from blender.scripts.concatenate_blends import IMG_TMP, SEG_TMP, _product_recipe
+
+    recipes = {product: _product_recipe(product, precision) for product in products}
+    quantised = [product for product in products
+                 if product in IMAGE_PRODUCTS and precision != "float32"]
+    templates = sorted({template for template, _, _ in recipes.values()}
+                       | ({IMG_TMP, SEG_TMP} if quantised else set()))
+
+    # The stacks are allocated from the first blend, and the quantised
+    # products converted blend by blend, so that a shard is held only once
+    count = stop - start
+    arrays: Dict[str, np.ndarray] = {}
+    scales = {product: np.ones(count) for product in quantised}
+    offsets = {product: np.zeros(count) for product in quantised}
+    max_errors = {product: np.zeros(count) for product in quantised}
+    sq_errors = {product: np.zeros(count) for product in quantised}
+    for position, idx in enumerate(range(start, stop)):
+        sources = {
+            template: np.load(datadir / template.format(prefix=prefix, idx=idx))
+            for template in templates
+        }
+        if quantised:
+            noise_std = background_std(sources[IMG_TMP].sum(axis=-1)[None],
+                                       sources[SEG_TMP][None])
+        for product, (template, builder, dtype) in recipes.items():
+            row = builder(sources[template])
+            if product in quantised:
+                stored, scale, offset = quantise(row[None], precision)
+                if scale is not None:
+                    scales[product][position] = scale[0]
+                    offsets[product][position] = offset[0]
+                max_error, sq_error = noise_relative_errors(row[None], stored, scale,
+                                                            offset, noise_std)
+                max_errors[product][position] = max_error[0]
+                sq_errors[product][position] = sq_error[0]
+                row = stored[0]
+            else:
+                row = row.astype(dtype, copy=False)
+            if product not in arrays:
+                arrays[product] = np.empty((count, *row.shape), dtype=row.dtype)
+            arrays[product][position] = row
+
+    columns = {name: column[start:stop] for name, column in columns.items()}
+    errors = {}
+    for product in quantised:
+        errors[product] = dict(max=float(max_errors[product].max()),
+                               sq=float(sq_errors[product].sum()))
+        if precision == "int16":
+            columns[f"{product}_scale"] = scales[product]
+            columns[f"{product}_offset"] = offsets[product]
+
+    tmpdir = shard_dir.with_name(f".{shard_dir.name}-{os.getpid()}")
+    tmpdir.mkdir(exist_ok=True)
+    for product, array in arrays.items():
+        np.save(tmpdir / f"{product}.npy", array)
+    for name, column in columns.items():
+        np.save(tmpdir / f"cat_{name}.npy", column)
+
+    checksums = {
+        filepath.name: file_checksum(filepath)
+        for filepath in sorted(tmpdir.glob("*.npy"))
+    }
+    if shard_dir.exists():
+        shutil.rmtree(shard_dir)
+    tmpdir.rename(shard_dir)
+
+    return dict(name=shard_dir.name, start=start, count=stop - start,
+                checksums=checksums, columns=list(columns), errors=errors)
+
+
+def write_shards(n_img: int, datadir: Path, prefix: str,
+                 products: Sequence[str], shard_size: int = 4096,
+                 n_jobs: int = 1, precision: str = "float32") -> Path:
+    """
+    Write one split of a dataset as shards of `shard_size` blends
+
+    Parameters
+    ----------
+    n_img:
+        number of individual blends
+    datadir:
+        directory containing the individual files and the catalogue
+    prefix: {'train','test'}
+        prefix of the image files corresponding to the split
+    products:
+        names of the products ('blends', 'single_images', or one of the
+        methods in `blender.segmap`)
+    shard_size: default 4096
+        number of blends per shard, the last one being possibly smaller
+    n_jobs: default 1
+        number of shards written concurrently
+    precision: {'float32','float16','int16'}
+        storage precision of the blends and single images, see
+        `blender.precision`
+
+    Returns
+    -------
+    path to the directory of the shards
+
+    """
+    import pandas as pd  # type: ignore
+
+    outdir = datadir / f"{prefix}_shards"
+    outdir.mkdir(exist_ok=True)
+
+    cat = pd.read_csv(datadir / f"{prefix}_catalogue.csv")
+    columns = {}
+    for name in cat.columns:
+        values = cat[name].to_numpy()
+        if values.dtype.kind == "O":
+            values = values.astype(str)
+        columns[name] = values
+
+    starts = range(0, n_img, shard_size)
+    msg = f"Writing the {prefix}ing shards"
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as pool, \
+            click.progressbar(length=n_img, label=msg) as bar:
+        futures = [
+            pool.submit(write_shard, datadir, prefix, products, columns,
+                        start, min(start + shard_size, n_img),
+                        outdir / SHARD_TMP.format(number=number), precision)
+            for number, start in enumerate(starts)
+        ]
+        for future in as_completed(futures):
+            bar.update(future.result()["count"])
+
+    shards = sorted((future.result() for future in futures),
+                    key=lambda shard: shard["start"])
+
+    layouts = {}
+    for product in products if shards else ():
+        array = np.load(outdir / shards[0]["name"] / f"{product}.npy", mmap_mode="r")
+        layouts[product] = dict(shape=list(array.shape[1:]), dtype=array.dtype.str)
+
+    # Quantisation errors in units of the background noise, over all shards
+    errors = {}
+    for product in (shards[0]["errors"] if shards else ()):
+        n_values = n_img * int(np.prod(layouts[product]["shape"]))
+        errors[product] = dict(
+            max=max(shard["errors"][product]["max"] for shard in shards),
+            rms=float(np.sqrt(sum(shard["errors"][product]["sq"]
+                                  for shard in shards) / n_values)),
+        )
+    shard_columns = shards[0]["columns"] if shards else list(columns)
+    for shard in shards:
+        del shard["errors"], shard["columns"]
+
+    index = dict(
+        version=SHARDS_VERSION,
+        n_blends=n_img,
+        shard_size=shard_size,
+        products=layouts,
+        precision=precision,
+        errors=errors,
+        columns=shard_columns,
+        shards=shards,
+    )
+    with open(outdir / INDEX_FILE, "w") as f:
+        json.dump(index, f, indent=2)
+
+    return outdir
+
+
+class ShardedArray:
+    """
+    Read-only array-like view of one product over all the shards
+
+    Supports `len`, `shape`, `dtype` and indexing of the first axis with
+    an integer, a slice or an array of indices, reading only the rows
+    needed from the memory-mapped shards.
+    """
+    def __init__(self, shards: List[np.ndarray], starts: np.ndarray) -> None:
+        self.shards = shards
+        self.starts = starts
+        self.length = int(starts[-1]) if len(starts) else 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def shape(self):
+        return (self.length, *self.shards[0].shape[1:])
+
+    @property
+    def dtype(self):
+        return self.shards[0].dtype
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key) -> np.ndarray:
+        if isinstance(key, (int, np.integer)):
+            if not -self.length <= key < self.length:
+                raise IndexError(f"index {key} is out of bounds for size {self.length}")
+            key = key % self.length
+            number = np.searchsorted(self.starts, key, side="right") - 1
+            return np.asarray(self.shards[number][key - self.starts[number]])
+
+        if isinstance(key, slice):
+            return self._read_range(range(*key.indices(self.length)))
+
+        indices = np.arange(self.length)[key]
+        output = np.empty((len(indices), *self.shape[1:]), dtype=self.dtype)
+        numbers = np.searchsorted(self.starts, indices, side="right") - 1
+        for number in np.unique(numbers):
+            selected = np.flatnonzero(numbers == number)
+            local = indices[selected] - self.starts[number]
+            order = np.argsort(local, kind="stable")
+            output[selected[order]] = read_rows(self.shards[number], local[order])
+        return output
+
+    def _read_range(self, rows: range) -> np.ndarray:
+        """Read a regularly spaced range of rows, shard by shard"""
+        output = np.empty((len(rows), *self.shape[1:]), dtype=self.dtype)
+        if not rows:
+            return output
+
+        # Fill the output in increasing order of the rows
+        if rows.step < 0:
+            rows, output_view = rows[::-1], output[::-1]
+        else:
+            output_view = output
+        first, step = rows[0], rows.step
+        lowest, highest = np.searchsorted(self.starts, [rows[0], rows[-1]],
+                                          side="right") - 1
+        for number in range(lowest, highest + 1):
+            start, stop = self.starts[number], self.starts[number + 1]
+            begin = max(0, -(-(start - first) // step))
+            end = min(len(rows), -(-(stop - first) // step))
+            if begin >= end:
+                continue
+            local = rows[begin:end]
+            output_view[begin:end] = self.shards[number][
+                local.start - start:local[-1] - start + 1:step]
+        return output
+
+
+class ShardedDataset:
+    """
+    Queryable view over one sharded split of a produced dataset
+
+    Exposes the same `products`, `array`, `where`, `take` and `query`
+    interface as `blender.dataset.BlendDataset`, the arrays returned by
+    `array` being `ShardedArray` instances.
+
+    Parameters
+    ----------
+    path:
+        directory of the dataset
+    prefix: {'train','test'}
+        split of the dataset
+
+    """
+    def __init__(self, path: PathType, prefix: str = "train") -> None:
+        self.path = Path(path) / f"{prefix}_shards"
+        self.prefix = prefix
+        with open(self.path / INDEX_FILE) as f:
+            self.index = json.load(f)
+        if self.index["version"] != SHARDS_VERSION:
+            raise ValueError(
+                f"Unsupported version {self.index['version']} of the shards "
+                f"in {self.path}")
+
+        shards = self.index["shards"]
+        self.starts = np.array([shard["start"] for shard in shards]
+                               + [self.index["n_blends"]])
+        self.columns = {
+            name: np.concatenate([
+                np.load(self.path / shard["name"] / f"cat_{name}.npy")
+                for shard in shards
+            ])
+            for name in self.index["columns"]
+        }
+
+    def __len__(self) -> int:
+        return self.index["n_blends"]
+
+    @property
+    def products(self) -> List[str]:
+        """Names of the products available for this split"""
+        return sorted(self.index["products"])
+
+    def locate(self, blend_id: int):
+        """Return the shard name and the offset of a blend in that shard"""
+        number = int(np.searchsorted(self.starts, blend_id, side="right")) - 1
+        shard = self.index["shards"][number]
+        return shard["name"], blend_id - shard["start"]
+
+    def array(self, product: str) -> ShardedArray:
+        """Array-like view of a product, e.g. 'blends' or 'ogg_masks'"""
+        if product not in self.index["products"]:
+            raise FileNotFoundError(
+                f"No {product} for the {self.prefix} split in {self.path}, "
+                f"available products are {self.products}")
+        shards = [
+            np.load(self.path / shard["name"] / f"{product}.npy", mmap_mode="r")
+            for shard in self.index["shards"]
+        ]
+        return ShardedArray(shards, self.starts)
+
+    def verify(self) -> List[str]:
+        """Return the names of the shard files whose checksum does not match"""
+        corrupted = []
+        for shard in self.index["shards"]:
+            for filename, checksum in shard["checksums"].items():
+                filepath = self.path / shard["name"] / filename
+                if not filepath.exists() or file_checksum(filepath) != checksum:
+                    corrupted.append(f"{shard['name']}/{filename}")
+        return corrupted
+
+    def where(self, condition: Union[str, Callable]) -> np.ndarray:
+        """
+        Return the sorted indices of the blends matching a condition,
+        see `BlendDataset.where`
+        """
+        return evaluate_condition(self.columns, condition)
+
+    def take(self, indices: Sequence[int],
+             products: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """
+        Read the catalogue entries and the products of the given blends,
+        in the order of the sorted indices, the blends and single images
+        as float32
+        """
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        if products is None:
+            products = self.products
+
+        subset = {name: column[indices] for name, column in self.columns.items()}
+        for product in products:
+            subset[product] = self.array(product)[indices]
+            if product in IMAGE_PRODUCTS:
+                # Images stored with a reduced precision come back as float32
+                subset[product] = dequantise(subset[product],
+                                             subset.get(f"{product}_scale"),
+                                             subset.get(f"{product}_offset"),
+                                             product)
+        return subset
+
+    def batches(self, batch_size: int, products: Optional[Sequence[str]] = None,
+                indices: Optional[Sequence[int]] = None) -> Iterator[Dict[str, np.ndarray]]:
+        """
+        Iterate over the blends by batches of `batch_size`, as returned by
+        `take`, by default over the whole split
+        """
+        indices = np.arange(len(self)) if indices is None else np.unique(indices)
+        for start in range(0, len(indices), batch_size):
+            yield self.take(indices[start:start + batch_size], products=products)
+
+    def query(self, condition: Union[str, Callable],
+              products: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """Shortcut for `take(where(condition), products)`"""
+        return self.take(self.where(condition), products=products)
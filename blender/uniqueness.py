@@ -0,0 +1,187 @@
+"""
+Detection of duplicated blends.
+
+A blend is identified by its galaxies and their shifts. These are hashed
+into 64-bit keys, which are kept in one of two key sets:
+
+  - `ExactKeySet`: a hashed set of the keys, exact up to 64-bit hash
+    collisions, taking a few tens of bytes per blend
+  - `BloomKeySet`: a Bloom filter of fixed size, taking a few bytes per
+    blend for a false positive rate of one in a million. A false positive
+    only rejects a blend that was actually new, so that duplicates never
+    get through.
+
+`count_unique_blends` gives the number of distinct two-galaxy blends that
+can be drawn from a split under the current cuts.
+"""
+from typing import Optional, Union
+
+import numpy as np  # type: ignore
+
+from blender.quotas import shift_limits
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+KEY_SETS = ("exact", "bloom")
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finaliser, scrambling uint64 values"""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def blend_keys(groups: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    """
+    Hash blends into 64-bit keys
+
+    Parameters
+    ----------
+    groups:
+        (B, K) catalogue indices of the galaxies, the central one first
+    shifts:
+        (B, K, 2) integer shifts of the galaxies
+
+    Returns
+    -------
+    (B,) uint64 keys
+
+    """
+    groups, shifts = np.asarray(groups), np.asarray(shifts)
+    shifts = shifts.reshape(len(groups), int(np.prod(shifts.shape[1:])))
+    values = np.concatenate([groups, shifts], axis=1).astype(np.int64).view(np.uint64)
+
+    keys = np.full(len(values), GOLDEN, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in values.T:
+            keys = _mix(keys + column * GOLDEN)
+    return keys
+
+
+class ExactKeySet:
+    """Set of blend keys, exact up to 64-bit hash collisions"""
+
+    def __init__(self) -> None:
+        self.keys = set()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, keys: np.ndarray) -> np.ndarray:
+        """Add keys to the set, returning True for the ones not seen yet"""
+        new = np.zeros(len(keys), dtype=bool)
+        for position, key in enumerate(keys.tolist()):
+            if key not in self.keys:
+                self.keys.add(key)
+                new[position] = True
+        return new
+
+
+class BloomKeySet:
+    """
+    Memory-bounded set of blend keys
+
+    Parameters
+    ----------
+    capacity:
+        expected number of keys
+    error_rate: default 1e-6
+        probability for a new key to be taken as already seen once the set
+        holds `capacity` keys
+
+    """
+    def __init__(self, capacity: int, error_rate: float = 1e-6) -> None:
+        capacity = max(capacity, 1)
+        self.n_bits = int(np.ceil(-capacity * np.log(error_rate) / np.log(2) ** 2))
+        self.n_hashes = max(int(round(self.n_bits / capacity * np.log(2))), 1)
+        self.bits = np.zeros(-(-self.n_bits // 8), dtype=np.uint8)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def _positions(self, keys: np.ndarray) -> np.ndarray:
+        # Double hashing: h1 + i * h2 for the i-th hash function
+        with np.errstate(over="ignore"):
+            step = _mix(keys ^ GOLDEN) | np.uint64(1)
+            index = np.arange(self.n_hashes, dtype=np.uint64)
+            positions = keys[:, None] + index[None, :] * step[:, None]
+        return positions % np.uint64(self.n_bits)
+
+    def add(self, keys: np.ndarray) -> np.ndarray:
+        """Add keys to the set, returning True for the ones not seen yet"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        new = np.zeros(len(keys), dtype=bool)
+        unique, first = np.unique(keys, return_index=True)
+
+        positions = self._positions(unique)
+        byte, bit = positions >> np.uint64(3), (positions & np.uint64(7)).astype(np.uint8)
+        seen = np.all((self.bits[byte] >> bit) & 1, axis=1)
+
+        np.bitwise_or.at(self.bits, byte[~seen].ravel(),
+                         np.left_shift(1, bit[~seen]).astype(np.uint8).ravel())
+        new[first[~seen]] = True
+        self.count += int((~seen).sum())
+        return new
+
+
+def key_set(kind: str, capacity: Optional[int] = None) -> Union[ExactKeySet, BloomKeySet]:
+    """Create an empty key set of the given kind, see `KEY_SETS`"""
+    if kind == "exact":
+        return ExactKeySet()
+    if kind == "bloom":
+        return BloomKeySet(capacity or 1)
+    raise ValueError(f"Unknown key set {kind}, expected one of {KEY_SETS}")
+
+
+def drawable_shifts(rad_min: np.ndarray, rad_max: np.ndarray) -> np.ndarray:
+    """
+    Number of distinct shifts `Blender.random_shift` can draw for each pair
+
+    The shifts are drawn along each axis with `randint(-rad_max, rad_max)`,
+    which truncates the bounds, so within [-floor(rad_max), floor(rad_max) - 1],
+    and kept if their distance is within [rad_min, rad_max].
+    """
+    bounds = np.floor(rad_max).astype(int)
+    counts = np.zeros(len(bounds), dtype=np.int64)
+    for bound in np.unique(bounds[bounds > 0]):
+        coords = np.arange(-bound, bound)
+        distances = np.sort(np.hypot(coords[:, None], coords[None, :]), axis=None)
+        selected = bounds == bound
+        counts[selected] = (
+            np.searchsorted(distances, rad_max[selected], side="right")
+            - np.searchsorted(distances, rad_min[selected], side="left"))
+    return np.maximum(counts, 0)
+
+
+def count_unique_blends(blender, from_test: bool = False,
+                        chunk_size: int = 1024) -> int:
+    """
+    Number of distinct two-galaxy blends that can be drawn from a split
+
+    Counts, for every pair of distinct galaxies within `magdiff` of each
+    other, the shifts that `Blender.random_shift` can draw, see
+    `drawable_shifts`. The pairs are processed by chunks of `chunk_size`
+    central galaxies to bound the memory.
+    """
+    pool = blender.split_indices(from_test)
+    mags = blender.cat.mag.to_numpy()[pool]
+    rads = blender.cat.radius.to_numpy()[pool]
+
+    total = 0
+    for start in range(0, len(pool), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(pool)))
+        allowed = np.abs(mags[rows, None] - mags[None, :]) < blender.magdiff
+        allowed[np.arange(len(rows)), rows] = False
+        g1, g2 = np.nonzero(allowed)
+        g1 = rows[g1]
+
+        rad_min, rad_max = shift_limits(rads[g1], rads[g2], blender.raddiff,
+                                        blender.img_size)
+        total += int(drawable_shifts(rad_min, rad_max).sum())
+
+    return total